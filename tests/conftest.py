@@ -0,0 +1,34 @@
+import pytest
+
+import vgarus_client.cache
+import vgarus_client.models
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    path = tmp_path / "cache"
+    monkeypatch.setenv(vgarus_client.cache.CACHE_DIR_ENV, str(path))
+    return path
+
+
+@pytest.fixture
+def sample():
+    sample_data = vgarus_client.models.SampleData(
+        sample_name="virus/2",
+        sample_pick_date="2023-05",
+        sample_pick_place="Moscow",
+        author="Author",
+        gisaid_id="EPI2",
+        biomater=0,
+        sample_type=1,
+        seq_area=1,
+        lung_damage=0,
+        vaccine=0,
+        issue=0,
+        foreign=0,
+        double_sick=0,
+    )
+    return vgarus_client.models.Sample(
+        sample_data=sample_data,
+        sequence=vgarus_client.models.Sequence(header="virus/2", body="AC GT"),
+    )
@@ -0,0 +1,72 @@
+import os
+import pickle
+
+import pytest
+
+import vgarus_client.cache
+
+
+def test_store_and_load(tmp_path, sample):
+    input_file = tmp_path / "input.json"
+    input_file.write_text("[]")
+
+    key = vgarus_client.cache.get_key(input_file)
+    assert vgarus_client.cache.load(key) is None
+
+    vgarus_client.cache.store(key, [sample])
+    loaded = vgarus_client.cache.load(key)
+
+    assert loaded is not None
+    assert len(loaded) == 1
+    assert loaded[0].sample_data == sample.sample_data
+    assert loaded[0].sequence.header == "virus_2"
+    assert loaded[0].sequence.body == "ACGT"
+    assert loaded[0].export() == sample.export()
+
+
+def test_key_changes_with_content(tmp_path):
+    input_file = tmp_path / "input.json"
+    input_file.write_text("[]")
+    key = vgarus_client.cache.get_key(input_file)
+
+    input_file.write_text("{}")
+    assert vgarus_client.cache.get_key(input_file) != key
+
+
+def test_clear(tmp_path, sample):
+    input_file = tmp_path / "input.json"
+    input_file.write_text("[]")
+    key = vgarus_client.cache.get_key(input_file)
+    vgarus_client.cache.store(key, [sample])
+
+    assert vgarus_client.cache.clear() == 1
+    assert vgarus_client.cache.load(key) is None
+
+
+def test_evict_least_recently_used(tmp_path, cache_dir, sample):
+    keys = []
+    for i in range(3):
+        input_file = tmp_path / f"input{i}.json"
+        input_file.write_text(str(i))
+        keys.append(vgarus_client.cache.get_key(input_file))
+        vgarus_client.cache.store(keys[-1], [sample])
+    entries = sorted(cache_dir.glob("*.pickle"), key=lambda path: path.name)
+    for i, path in enumerate(entries):
+        os.utime(path, ns=(i, i))
+    # Loading marks the oldest entry as recently used
+    oldest = min(keys, key=lambda key: (cache_dir / f"{key}.pickle").stat().st_mtime)
+    assert vgarus_client.cache.load(oldest) is not None
+
+    entry_size = entries[0].stat().st_size
+    assert vgarus_client.cache.evict(max_size=entry_size) == 2
+    assert [path.stem for path in cache_dir.glob("*.pickle")] == [oldest]
+
+
+def test_store_removes_tmp_on_error(monkeypatch, tmp_path, cache_dir, sample):
+    def fail(*args, **kwargs):
+        raise pickle.PicklingError("broken")
+
+    monkeypatch.setattr(vgarus_client.cache.pickle, "dump", fail)
+    vgarus_client.cache.store("key", [sample])
+
+    assert list(cache_dir.iterdir()) == []
@@ -76,3 +76,26 @@ def test_send_data(monkeypatch, client, status_code, response_json, result):
 
     res = client.send_batch([])
     assert res == result
+
+
+def test_timeouts_scale_with_throughput(monkeypatch, client):
+    timeouts = []
+
+    def mock_post(*args, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        return MockResponse(response_json={"status": 200, "message": []})
+
+    monkeypatch.setattr(requests, "request", mock_post)
+
+    client._send_request("POST", "", [{}], max_timeout=5)
+    assert timeouts[-1] == (5, 5)
+    assert client.throughput is not None
+
+    client.throughput = 1000
+    assert client.get_read_timeout(0) == client.READ_TIMEOUT
+    assert client.get_read_timeout(1000) == client.MIN_READ_TIMEOUT
+    assert client.get_read_timeout(10**5) == 100 * client.READ_TIMEOUT_FACTOR
+    assert client.get_read_timeout(10**9) == client.MAX_READ_TIMEOUT
+
+    client._send_request("POST", "", [{}])
+    assert timeouts[-1] == (client.CONNECT_TIMEOUT, client.MIN_READ_TIMEOUT)
@@ -0,0 +1,165 @@
+import gzip
+import zlib
+
+import pytest
+
+import vgarus_client.io_utils
+
+FASTA = ">virus/1 description\nACGT\nAC\n>virus_2\nGGGG\n"
+
+METADATA_FIELDS = [
+    "virus_name",
+    "collection_date",
+    "location",
+    "authors",
+    "gisaid_id",
+    "specimen",
+    "passage",
+    "target",
+    "lung_damage",
+    "vaccine",
+    "outcome",
+    "travel",
+    "reinfection",
+]
+METADATA_HEADER = "\t".join(METADATA_FIELDS) + "\n"
+
+
+def metadata_row(virus_name: str) -> str:
+    return f"{virus_name}\t2023\tMoscow\tAuthor\tEPI\t0\t1\t1\t0\t0\t0\t0\t0\n"
+
+
+@pytest.mark.parametrize("suffix", ["", ".gz", ".zst"])
+def test_open_text_roundtrip(tmp_path, suffix):
+    if suffix == ".zst":
+        pytest.importorskip("zstandard")
+    path = tmp_path / f"sequences.fasta{suffix}"
+
+    with vgarus_client.io_utils.open_text(path, "wt") as fo:
+        fo.write(FASTA)
+
+    with vgarus_client.io_utils.open_text(path) as fi:
+        assert fi.read() == FASTA
+
+
+@pytest.mark.parametrize("suffix", ["", ".gz", ".zst"])
+def test_fasta_index_compressed(tmp_path, suffix):
+    if suffix == ".zst":
+        pytest.importorskip("zstandard")
+    path = tmp_path / f"sequences.fasta{suffix}"
+    with vgarus_client.io_utils.open_text(path, "wt") as fo:
+        fo.write(FASTA)
+
+    index = vgarus_client.io_utils.FastaIndex(path)
+    sequences = [index.get(name) for name in ("virus_1", "virus_2")]
+
+    assert [(s.header, s.body) for s in sequences if s is not None] == [
+        ("virus_1", "ACGTAC"),
+        ("virus_2", "GGGG"),
+    ]
+
+
+def write_bgzf(path, data: bytes, block_size: int) -> None:
+    with open(path, "wb") as fo:
+        for start in range(0, len(data), block_size):
+            block = data[start : start + block_size]
+            compressor = zlib.compressobj(wbits=-15)
+            deflated = compressor.compress(block) + compressor.flush()
+            fo.write(
+                b"\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0"
+                + (len(deflated) + 25).to_bytes(2, "little")
+                + deflated
+                + zlib.crc32(block).to_bytes(4, "little")
+                + len(block).to_bytes(4, "little")
+            )
+        # End of file marker
+        fo.write(
+            bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+        )
+
+
+def test_open_text_bgzf(tmp_path):
+    path = tmp_path / "metadata.tsv.gz"
+    content = METADATA_HEADER + "".join(metadata_row(f"virus_{i}") for i in range(500))
+    write_bgzf(path, content.encode(), block_size=1000)
+
+    assert vgarus_client.io_utils.is_bgzf(path)
+    with gzip.open(path, "rt") as fi:
+        assert fi.read() == content
+    with vgarus_client.io_utils.open_text(path) as fi:
+        assert fi.read() == content
+
+
+def test_detect_compression_ignores_suffix(tmp_path):
+    path = tmp_path / "sequences.fasta"
+    path.write_bytes(gzip.compress(FASTA.encode()))
+
+    assert vgarus_client.io_utils.detect_compression(path) == "gzip"
+
+
+def test_strip_compression_suffix(tmp_path):
+    path = tmp_path / "package.json.zst"
+    assert vgarus_client.io_utils.strip_compression_suffix(path).name == "package.json"
+
+
+@pytest.mark.parametrize("suffix", ["", ".gz", ".zst"])
+def test_fasta_index(tmp_path, suffix):
+    if suffix == ".zst":
+        pytest.importorskip("zstandard")
+    path = tmp_path / f"sequences.fasta{suffix}"
+    with vgarus_client.io_utils.open_text(path, "wt") as fo:
+        fo.write(FASTA + ">virus-3\nTT\n>virus_3\nCC\n>virus/3\nAA\n")
+
+    index = vgarus_client.io_utils.FastaIndex(path)
+
+    assert len(index) == 3
+    assert index.collisions == {"virus_3": ["virus_3", "virus/3"]}
+    sequence = index.get("virus_1")
+    assert sequence is not None
+    assert (sequence.header, sequence.body) == ("virus_1", "ACGTAC")
+    assert index.get("virus_3") is None
+    assert index.get("missing") is None
+
+
+def test_read_fasta_and_tsv_to_samples(tmp_path, caplog):
+    fasta = tmp_path / "sequences.fasta"
+    fasta.write_text(FASTA + ">virus/3\nTT\n>virus_3\nCC\n")
+    metadata = tmp_path / "metadata.tsv"
+    metadata.write_text(
+        METADATA_HEADER
+        + "".join(metadata_row(name) for name in ["virus_2", "virus/3", "missing"])
+    )
+
+    samples = vgarus_client.io_utils.read_fasta_and_tsv_to_samples(fasta, metadata)
+
+    assert [sample.sequence.body for sample in samples] == ["GGGG"]
+    assert "1 names in" in caplog.text
+    assert "1 virus names from metadata not found in fasta: missing" in caplog.text
+
+
+def test_cached_samples_repeat_warnings(tmp_path, cache_dir, caplog):
+    fasta = tmp_path / "sequences.fasta"
+    fasta.write_text(FASTA + ">virus/3\nTT\n>virus_3\nCC\n")
+    metadata = tmp_path / "metadata.tsv"
+    metadata.write_text(
+        METADATA_HEADER + "".join(metadata_row(name) for name in ["virus_2", "missing"])
+    )
+
+    for cached in (False, True):
+        assert bool(list(cache_dir.glob("*.pickle"))) == cached
+        caplog.clear()
+        samples = vgarus_client.io_utils.read_fasta_and_tsv_to_samples(
+            fasta, metadata, use_cache=True
+        )
+        assert len(samples) == 1
+        assert "1 names in" in caplog.text
+        assert "not found in fasta: missing" in caplog.text
+
+
+def test_jsonl_package_roundtrip(tmp_path, sample):
+    package = tmp_path / "package.jsonl"
+    vgarus_client.io_utils.write_jsonl_samples(iter([sample, sample]), package)
+
+    samples = list(vgarus_client.io_utils.iter_jsonl_samples(package))
+    assert [s.export() for s in samples] == [sample.export()] * 2
+    assert vgarus_client.io_utils.read_json_to_samples(package) == samples
@@ -0,0 +1,147 @@
+import csv
+import json
+import os
+
+import vgarus_client.enums
+import vgarus_client.jobs
+import vgarus_client.models
+
+
+def test_scan(tmp_path):
+    for name in [
+        "package.json",
+        "package.result.tsv",
+        "metadata.tsv",
+        "metadata.fasta.gz",
+        "metadata.leftover.tsv",
+        "orphan.tsv",
+    ]:
+        (tmp_path / name).touch()
+
+    jobs = vgarus_client.jobs.scan(tmp_path)
+
+    assert [(job.package, job.metadata, job.fasta) for job in jobs] == [
+        (None, tmp_path / "metadata.tsv", tmp_path / "metadata.fasta.gz"),
+        (tmp_path / "package.json", None, None),
+    ]
+
+
+def test_scan_skips_unsettled_files(tmp_path):
+    (tmp_path / "package.json").touch()
+
+    assert vgarus_client.jobs.scan(tmp_path, settle=60) == []
+
+
+def test_queue(tmp_path):
+    package = tmp_path / "package.json"
+    package.touch()
+    queue = vgarus_client.jobs.JobQueue(tmp_path / "queue.sqlite")
+
+    assert queue.enqueue(vgarus_client.models.UploadJob(package=package))
+    assert not queue.enqueue(vgarus_client.models.UploadJob(package=package))
+
+    job = queue.take()
+    assert job is not None
+    assert job.package == package
+    assert job.status == vgarus_client.enums.JobStatus.RUNNING
+    assert queue.take() is None
+
+    # Jobs of a live owner are left alone, stale ones are taken over
+    other = vgarus_client.jobs.JobQueue(tmp_path / "queue.sqlite")
+    assert queue.requeue_stale(stale_after=0) == 0
+    assert other.requeue_stale() == 0
+    assert other.requeue_stale(stale_after=0) == 1
+    assert not queue.update(job)
+    job = other.take()
+    assert job is not None
+    queue.close()
+    queue = other
+
+    job.status = vgarus_client.enums.JobStatus.DONE
+    job.ok = 3
+    queue.update(job)
+    queue.close()
+
+    queue = vgarus_client.jobs.JobQueue(tmp_path / "queue.sqlite")
+    (job,) = queue.get_jobs(vgarus_client.enums.JobStatus.DONE)
+    assert job.ok == 3
+    assert queue.take() is None
+
+
+class MockClient:
+    def __init__(self, crash_after: int | None = None) -> None:
+        self.crash_after = crash_after
+        self.batches: list[list[str]] = []
+
+    def send_batch(self, batch, max_timeout=None):
+        if len(self.batches) == self.crash_after:
+            raise RuntimeError("Crash")
+        self.batches.append([sample.sample_data.virus_name for sample in batch])
+        return vgarus_client.models.VgarusResponse(
+            status=200, message=[f"id{len(self.batches)}"]
+        )
+
+
+def test_requeued_job_resumes(tmp_path, sample):
+    other = sample.copy(deep=True)
+    other.sample_data.virus_name = other.sequence.header = "virus_3"
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    package = inbox / "package.json"
+    package.write_text(json.dumps([sample.export(), other.export()]))
+    database = tmp_path / "queue.sqlite"
+
+    crashed = vgarus_client.jobs.JobQueue(database)
+    crashed.enqueue(vgarus_client.models.UploadJob(package=package))
+    job = crashed.take()
+    assert job is not None
+    try:
+        vgarus_client.jobs.run_job(MockClient(crash_after=1), job, batch_size=1)  # type: ignore
+    except RuntimeError:
+        pass
+    results = inbox / "package.result.tsv"
+    # Writing of the next row was interrupted too
+    with open(results, "a") as fo:
+        fo.write("virus_3\tEPI")
+
+    queue = vgarus_client.jobs.JobQueue(database)
+    assert queue.requeue_stale(stale_after=0) == 1
+    client = MockClient()
+    vgarus_client.jobs.watch(client, queue, [inbox], once=True, batch_size=1)  # type: ignore
+
+    (job,) = queue.get_jobs()
+    assert job.status == vgarus_client.enums.JobStatus.DONE
+    assert (job.ok, job.not_ok, job.attempts) == (2, 0, 2)
+    assert client.batches == [["virus_3"]]
+    with open(results, newline="") as fi:
+        rows = list(csv.DictReader(fi, delimiter="\t"))
+    assert [(row["virus_name"], row["vgarus_id"]) for row in rows] == [
+        ("virus_2", "id1"),
+        ("virus_3", "id1"),
+    ]
+
+
+def test_changed_job_is_uploaded_again(tmp_path, sample):
+    other = sample.copy(deep=True)
+    other.sample_data.virus_name = other.sequence.header = "virus_3"
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    package = inbox / "package.json"
+    package.write_text(json.dumps([sample.export()]))
+    queue = vgarus_client.jobs.JobQueue(tmp_path / "queue.sqlite")
+    client = MockClient()
+
+    vgarus_client.jobs.watch(client, queue, [inbox], once=True, settle=0)  # type: ignore
+    vgarus_client.jobs.watch(client, queue, [inbox], once=True, settle=0)  # type: ignore
+    assert client.batches == [["virus_2"]]
+
+    package.write_text(json.dumps([sample.export(), other.export()]))
+    os.utime(package, ns=(0, 0))
+    vgarus_client.jobs.watch(client, queue, [inbox], once=True, settle=0)  # type: ignore
+
+    (job,) = queue.get_jobs()
+    assert job.status == vgarus_client.enums.JobStatus.DONE
+    assert (job.ok, job.revision) == (2, 1)
+    assert client.batches == [["virus_2"], ["virus_2"], ["virus_3"]]
+    assert (inbox / "package.result.tsv.0").exists()
+    assert len((inbox / "package.result.tsv").read_text().splitlines()) == 3
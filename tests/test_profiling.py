@@ -0,0 +1,42 @@
+import pstats
+
+import vgarus_client.profiling
+
+
+def test_stage_disabled():
+    with vgarus_client.profiling.stage("reader"):
+        pass
+    assert list(vgarus_client.profiling.iter_stage([1, 2], "reader")) == [1, 2]
+
+
+def test_profile(tmp_path):
+    output = tmp_path / "stats.pstats"
+    with vgarus_client.profiling.profile(
+        pstats_output=output, trace_allocations=True
+    ) as profiler:
+        with vgarus_client.profiling.stage("validator"):
+            data = [bytearray(1024) for _ in range(100)]
+        items = list(vgarus_client.profiling.iter_stage(data, "reader"))
+
+    assert len(items) == 100
+    assert profiler.stages["validator"].calls == 1
+    assert profiler.stages["validator"].allocated >= 100 * 1024
+    # Including the last call that exhausts the iterator
+    assert profiler.stages["reader"].calls == 101
+    assert "validator" in profiler.format_table()
+    assert pstats.Stats(str(output)).total_calls > 0
+
+    # Profiling is disabled on exit
+    with vgarus_client.profiling.stage("writer"):
+        pass
+    assert "writer" not in profiler.stages
+
+
+def test_profile_without_allocations():
+    with vgarus_client.profiling.profile() as profiler:
+        with vgarus_client.profiling.stage("validator"):
+            data = [bytearray(1024) for _ in range(100)]
+
+    assert len(data) == 100
+    assert profiler.stages["validator"].allocated == 0
+    assert "alloc" not in profiler.format_table()
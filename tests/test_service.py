@@ -1,3 +1,4 @@
+import json
 import warnings
 
 import pytest
@@ -67,3 +68,72 @@ def test_get_upload_results(virus_names, response, vgarus_ids):
     assert len(results) == len(batch)
     for result, vgarus_id in zip(results, vgarus_ids):
         assert result.vgarus_id == vgarus_id
+
+
+class MockClient:
+    def __init__(self, responses: list) -> None:
+        self.responses = responses
+        self.timeouts: list[float | None] = []
+
+    def send_batch(self, batch, max_timeout=None):
+        self.timeouts.append(max_timeout)
+        response = self.responses.pop(0)
+        if response is None:
+            raise ValueError("No response")
+        return response
+
+
+def test_upload_samples_keeps_failed_batches(sample):
+    batches = [[sample], [sample], [sample]]
+    client = MockClient(
+        [
+            vgarus_client.models.VgarusResponse(status=200, message=["id1"]),
+            None,
+            vgarus_client.models.VgarusResponse(status=500, message=[]),
+        ]
+    )
+
+    uploaded = list(vgarus_client.service.upload_samples(client, batches))  # type: ignore
+
+    assert [batch for _, batch in uploaded] == batches
+    assert [[r.vgarus_id for r in results] for results, _ in uploaded] == [
+        ["id1"],
+        [None],
+        [None],
+    ]
+    assert client.timeouts == [None, None, None]
+
+
+def test_upload_samples_deadline(monkeypatch, sample):
+    batches = [[sample], [sample]]
+    client = MockClient(
+        [vgarus_client.models.VgarusResponse(status=200, message=["id1"])]
+    )
+    now = iter([0.0, 1.0, 11.0])
+    monkeypatch.setattr(vgarus_client.service.time, "monotonic", lambda: next(now))
+
+    uploaded = list(
+        vgarus_client.service.upload_samples(client, batches, deadline=10)  # type: ignore
+    )
+
+    assert client.timeouts == [9.0]
+    assert [[r.vgarus_id for r in results] for results, _ in uploaded] == [
+        ["id1"],
+        [None],
+    ]
+
+
+def test_make_batches_by_bytes_without_batch_size(sample):
+    samples = [sample] * 4
+    size = vgarus_client.service.get_payload_size(samples[0])
+
+    batches = vgarus_client.service.make_batches(samples, max_batch_bytes=2 * size)
+    assert batches == [samples[:2], samples[2:]]
+    assert len(json.dumps([sample.export() for sample in batches[0]])) == 2 * size
+    assert len(
+        vgarus_client.service.make_batches(samples, max_batch_bytes=2 * size - 1)
+    ) == len(samples)
+
+    streamed = vgarus_client.service.make_batches(iter(samples), batch_size=3)
+    assert not isinstance(streamed, list)
+    assert list(streamed) == [samples[:3], samples[3:]]
@@ -0,0 +1,147 @@
+import json
+import sqlite3
+
+import pytest
+
+import vgarus_client.io_utils
+import vgarus_client.models
+import vgarus_client.sinks
+
+
+RESULT = vgarus_client.models.UploadResult(
+    virus_name="virus1", gisaid_id="EPI1", vgarus_id="id1"
+)
+
+
+@pytest.mark.parametrize("kind", ["tsv", "jsonl"])
+def test_file_sink_removes_empty_leftover(tmp_path, kind):
+    sink = vgarus_client.sinks.get_sink(kind, base=tmp_path / "upload")
+    with sink:
+        sink.write_batch([RESULT], [])
+
+    assert sink.results_path.exists()  # type: ignore
+    assert not sink.leftover_path.exists()  # type: ignore
+
+
+def test_jsonl_sink(tmp_path, sample):
+    sink = vgarus_client.sinks.JsonLinesSink(tmp_path / "upload")
+    with sink:
+        sink.write_batch([RESULT], [sample])
+
+    assert sink.existing_outputs() == [sink.results_path, sink.leftover_path]
+    (result,) = sink.results_path.read_text().splitlines()
+    assert json.loads(result)["vgarus_id"] == "id1"
+    (leftover,) = sink.leftover_path.read_text().splitlines()
+    assert json.loads(leftover)["virus_name"] == "virus_2"
+
+
+def test_sqlite_sink_appends(tmp_path, sample):
+    database = tmp_path / "history.sqlite"
+    source = tmp_path / "package.json"
+    runs = []
+    for _ in range(2):
+        with vgarus_client.sinks.SqliteSink(database, source=source) as sink:
+            sink.write_batch([RESULT], [sample])
+        runs.append(sink.run)
+
+    connection = sqlite3.connect(database)
+    assert connection.execute(
+        "SELECT run, source, virus_name, gisaid_id, submittion_date, vgarus_id "
+        "FROM results WHERE vgarus_id = ? ORDER BY rowid",
+        ("id1",),
+    ).fetchall() == [
+        (
+            run,
+            str(source),
+            "virus1",
+            "EPI1",
+            RESULT.submittion_date.isoformat(),
+            "id1",
+        )
+        for run in runs
+    ]
+    assert connection.execute(
+        "SELECT run, gisaid_id FROM leftover WHERE created IS NOT NULL "
+        "ORDER BY rowid"
+    ).fetchall() == [(run, "EPI2") for run in runs]
+
+
+def test_leftover_package_sink(tmp_path, sample):
+    base = tmp_path / "upload"
+    sink = vgarus_client.sinks.get_sink("tsv", base=base, leftover_package="json")
+    with sink:
+        sink.write_batch([RESULT], [sample])
+        sink.write_batch([], [sample])
+
+    assert vgarus_client.io_utils.read_json_to_samples(
+        base.with_suffix(".leftover.json")
+    ) == [sample, sample]
+    assert sink.existing_outputs() == [
+        base.with_suffix(".result.tsv"),
+        base.with_suffix(".leftover.tsv"),
+        base.with_suffix(".leftover.json"),
+    ]
+
+
+def test_leftover_package_sink_resume(tmp_path, sample):
+    base = tmp_path / "upload"
+    with vgarus_client.sinks.get_sink(
+        "tsv", base=base, leftover_package="json"
+    ) as sink:
+        sink.write_batch([RESULT], [sample])
+    package = base.with_suffix(".leftover.json")
+    # Interrupted run leaves the array unclosed and the last sample cut off
+    package.write_text(package.read_text()[:-1] + ', {"sample_data": {')
+
+    sink = vgarus_client.sinks.get_sink("tsv", base=base, leftover_package="json")
+    assert sink.resume() == ({"virus1"}, {"virus_2"})
+    assert sink.existing_outputs() == []
+    with sink:
+        sink.write_batch([], [sample])
+
+    assert vgarus_client.io_utils.read_json_to_samples(package) == [sample, sample]
+    assert len(base.with_suffix(".result.tsv").read_text().splitlines()) == 2
+
+
+def test_leftover_fasta_retry(tmp_path, sample):
+    base = tmp_path / "upload"
+    with vgarus_client.sinks.get_sink(
+        "tsv", base=base, leftover_package="fasta"
+    ) as sink:
+        sink.write_batch([], [sample])
+
+    samples = vgarus_client.io_utils.read_fasta_and_tsv_to_samples(
+        fasta_file=base.with_suffix(".leftover.fasta"),
+        tsv_file=base.with_suffix(".leftover.tsv"),
+    )
+    assert [s.export() for s in samples] == [sample.export()]
+
+
+def test_stdout_sink(capsys, sample):
+    sink = vgarus_client.sinks.get_sink("tsv", base=vgarus_client.io_utils.STDIO)
+    with sink:
+        sink.write_batch([RESULT], [sample])
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["vgarus_id"] for line in lines] == ["id1", None]
+    assert json.loads(lines[1])["virus_name"] == sample.sample_data.virus_name
+
+    with pytest.raises(ValueError):
+        vgarus_client.sinks.get_sink(
+            "tsv", base=vgarus_client.io_utils.STDIO, leftover_package="json"
+        )
+
+
+def test_sinks_are_abstract():
+    with pytest.raises(TypeError):
+        vgarus_client.sinks.ResultSink()  # type: ignore
+
+
+def test_tsv_leftover_keeps_line_breaks(tmp_path, sample):
+    sample.sample_data.authors = "Author\rOther\nThird"
+    base = tmp_path / "upload"
+    with vgarus_client.sinks.get_sink("tsv", base=base) as sink:
+        sink.write_batch([], [sample])
+
+    (data,) = vgarus_client.io_utils.iter_sample_data(base.with_suffix(".leftover.tsv"))
+    assert data.authors == "Author\rOther\nThird"
@@ -14,3 +14,31 @@ import vgarus_client.utils
 def test_complete_iso_date_string(raw_date, complited_date):
     res = vgarus_client.utils.complete_iso_date_string(raw_date)
     assert res == complited_date
+
+
+@pytest.mark.parametrize(
+    "window,batches",
+    [
+        (1, [[5], [3], [4, 1], [2]]),
+        (3, [[5, 1], [3, 2], [4]]),
+    ],
+)
+def test_iter_batches_by_weight(window, batches):
+    res = vgarus_client.utils.iter_batches_by_weight(
+        [5, 3, 4, 1, 2], weight=lambda x: x, max_weight=6, max_size=2, window=window
+    )
+    assert list(res) == batches
+
+
+def test_iter_batches_by_weight_oversized_item():
+    res = vgarus_client.utils.iter_batches_by_weight(
+        [1, 10, 1], weight=lambda x: x, max_weight=5, max_size=10
+    )
+    assert list(res) == [[1], [10], [1]]
+
+
+def test_iter_batches_by_weight_unbounded_size():
+    res = vgarus_client.utils.iter_batches_by_weight(
+        [1] * 7, weight=lambda x: x, max_weight=3
+    )
+    assert list(res) == [[1, 1, 1], [1, 1, 1], [1]]
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import pickle
+from pathlib import Path
+
+from . import models
+
+logger = logging.getLogger("vgarus")
+
+CACHE_DIR_ENV = "VGARUS_CACHE_DIR"
+DEFAULT_CACHE_DIR = Path("~/.cache/vgarus")
+CACHE_MAX_MB_ENV = "VGARUS_CACHE_MAX_MB"
+DEFAULT_CACHE_MAX_MB = 1024
+CACHE_VERSION = 2
+CACHE_SUFFIX = ".pickle"
+
+CHUNK_SIZE = 1 << 20
+
+CompactSample = tuple[dict, str, str]
+
+
+def get_cache_dir() -> Path:
+    return Path(os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR)).expanduser()
+
+
+def get_cache_max_size() -> int:
+    """Cache size limit in bytes"""
+
+    return int(os.environ.get(CACHE_MAX_MB_ENV, DEFAULT_CACHE_MAX_MB)) * 2**20
+
+
+def _get_entries(cache_dir: Path) -> list[Path]:
+    return [*cache_dir.glob(f"*{CACHE_SUFFIX}"), *cache_dir.glob("fasta/*.fxi")]
+
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fi:
+        while chunk := fi.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_key(*files: Path) -> str:
+    """Cache key from paths, sizes, mtimes and content hashes of input files"""
+
+    h = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+    for file in files:
+        stat = file.stat()
+        h.update(
+            f"{file.resolve()}\0{stat.st_size}\0{stat.st_mtime_ns}\0"
+            f"{file_digest(file)}\0".encode()
+        )
+    return h.hexdigest()
+
+
+def get_fasta_index_path(fasta_file: Path) -> Path:
+    """Path for pyfastx index of a fasta file, keyed by its path, size and mtime"""
+
+    stat = fasta_file.stat()
+    key = hashlib.sha256(
+        f"{fasta_file.resolve()}\0{stat.st_size}\0{stat.st_mtime_ns}".encode()
+    ).hexdigest()
+    return get_cache_dir() / "fasta" / f"{key}.fxi"
+
+
+def _to_compact(sample: models.Sample) -> CompactSample:
+    return sample.sample_data.dict(), sample.sequence.header, sample.sequence.body
+
+
+def _from_compact(compact: CompactSample) -> models.Sample:
+    data, header, body = compact
+    # Everything in the cache has already passed validation
+    return models.Sample.construct(
+        sample_data=models.SampleData.construct(**data),
+        sequence=models.Sequence.construct(header=header, body=body),
+    )
+
+
+def load(key: str) -> list[models.Sample] | None:
+    path = get_cache_dir() / f"{key}{CACHE_SUFFIX}"
+    if not path.exists():
+        return None
+    try:
+        with open(path, "rb") as fi:
+            compact_samples, warnings = pickle.load(fi)
+    except Exception as e:
+        logger.warning("Broken cache entry %s: %s", path, e)
+        path.unlink(missing_ok=True)
+        return None
+    # Modification time marks recent use for eviction
+    path.touch()
+    logger.debug("Loaded %s samples from cache %s", len(compact_samples), path)
+    # Samples dropped while reading are reported on every run
+    for warning in warnings:
+        logger.warning("%s", warning)
+    return [_from_compact(compact) for compact in compact_samples]
+
+
+def store(
+    key: str, samples: list[models.Sample], warnings: list[str] | None = None
+) -> None:
+    """Stores samples with warnings logged while reading them"""
+
+    cache_dir = get_cache_dir()
+    path = cache_dir / f"{key}{CACHE_SUFFIX}"
+    tmp_path = path.with_suffix(".tmp")
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "wb") as fo:
+            pickle.dump(
+                ([_to_compact(sample) for sample in samples], warnings or []),
+                fo,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning("Can't write cache entry %s: %s", path, e)
+        return
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    logger.debug("Stored %s samples in cache %s", len(samples), path)
+    evict()
+
+
+def evict(max_size: int | None = None) -> int:
+    """Removes least recently used entries above the size limit,
+    returns number of removed entries"""
+
+    if max_size is None:
+        max_size = get_cache_max_size()
+    entries = []
+    for path in _get_entries(get_cache_dir()):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # Removed by a concurrent run
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    if removed:
+        logger.debug("Evicted %s cache entries", removed)
+    return removed
+
+
+def clear() -> int:
+    """Removes all cache entries, returns number of removed entries"""
+
+    cache_dir = get_cache_dir()
+    if not cache_dir.exists():
+        return 0
+    removed = 0
+    for path in _get_entries(cache_dir):
+        path.unlink()
+        removed += 1
+    return removed
@@ -1,66 +1,232 @@
 import csv
+import functools
 import json
 import logging
 import logging.config
-import math
 from pathlib import Path
+from typing import Iterable
 
 import click
+import requests
+import requests.adapters
 from tqdm import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 
-from vgarus_client import io_utils, logging_config, models, service, utils
+from vgarus_client import (
+    cache,
+    io_utils,
+    jobs,
+    logging_config,
+    models,
+    profiling,
+    service,
+    sinks,
+    utils,
+)
 
 logging.config.dictConfig(logging_config.LOGGING)
 logger = logging.getLogger("vgarus")
 
 
+def profile_option(command):
+    """Adds --profile, --profile-memory and --profile-output options to a command"""
+
+    @click.option("--profile", is_flag=True, help="Print time spent in each stage")
+    @click.option(
+        "--profile-memory",
+        is_flag=True,
+        help="Also trace memory allocated in each stage, slows down the run, "
+        "implies --profile",
+    )
+    @click.option(
+        "--profile-output",
+        type=click.Path(dir_okay=False, path_type=Path),
+        help="Dump cProfile stats to file, implies --profile",
+    )
+    @functools.wraps(command)
+    def wrapper(
+        *args,
+        profile: bool,
+        profile_memory: bool,
+        profile_output: Path | None,
+        **kwargs,
+    ):
+        if not profile and not profile_memory and profile_output is None:
+            return command(*args, **kwargs)
+
+        with profiling.profile(
+            pstats_output=profile_output, trace_allocations=profile_memory
+        ) as profiler:
+            try:
+                return command(*args, **kwargs)
+            finally:
+                click.echo(profiler.format_table(), err=True)
+
+    return wrapper
+
+
+cache_option = click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    help="Reuse already validated samples from previous runs",
+    default=True,
+    show_default=True,
+)
+
+
+def _get_base(basename: str | None, source: Path) -> Path | None:
+    """Basename for outputs, None if it can't be derived from stdin"""
+
+    if basename:
+        return Path(basename)
+    if io_utils.is_stdio(source):
+        return None
+    return io_utils.get_basename(source)
+
+
+def _read_package(package: Path, use_cache: bool) -> Iterable[models.Sample]:
+    """Streams samples from stdin, reads files as a whole"""
+
+    if io_utils.is_stdio(package):
+        return io_utils.iter_jsonl_samples(package)
+    return io_utils.read_json_to_samples(package, use_cache=use_cache)
+
+
+def _is_leftover(path: Path) -> bool:
+    return io_utils.strip_compression_suffix(path).with_suffix("").suffix == ".leftover"
+
+
+def _read_fasta_and_tsv(
+    fasta: Path, metadata: Path, use_cache: bool
+) -> Iterable[models.Sample] | None:
+    """Streams samples if either input is stdin, None if both are"""
+
+    if io_utils.is_stdio(fasta) and io_utils.is_stdio(metadata):
+        return None
+    if io_utils.is_stdio(fasta) or io_utils.is_stdio(metadata):
+        return io_utils.iter_fasta_and_tsv_to_samples(
+            fasta_file=fasta, tsv_file=metadata
+        )
+    return io_utils.read_fasta_and_tsv_to_samples(
+        fasta_file=fasta, tsv_file=metadata, use_cache=use_cache
+    )
+
+
 @click.group()
 def cli():
     pass
 
 
 @cli.command()
-@click.argument("package", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@profile_option
+@click.argument(
+    "package",
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=Path),
+)
 @click.option("--basename", "-b", help="Basename for output files")
-def split_package(package: Path, basename: str | None = None) -> None:
-    """Split single json package to fasta and metadata tsv"""
+@cache_option
+@click.option(
+    "--compression",
+    "-c",
+    type=click.Choice(list(io_utils.COMPRESSION_DEFAULT_SUFFIXES)),
+    help="Compress output files",
+)
+def split_package(
+    package: Path,
+    basename: str | None = None,
+    use_cache: bool = True,
+    compression: str | None = None,
+) -> None:
+    """Split single json package to fasta and metadata tsv.
+
+    Package `-` is read from stdin as JSON Lines.
+    """
 
-    samples = io_utils.read_json_to_samples(package)
+    base = _get_base(basename, package)
+    if base is None or io_utils.is_stdio(base):
+        click.echo("Pass basename for stdin input, outputs can't be stdout", err=True)
+        return
 
-    metadata = io_utils.samples_to_tsv(samples)
-    fasta = io_utils.samples_to_fasta(samples)
+    samples = _read_package(package, use_cache=use_cache)
 
-    base = Path(basename) if basename else package
-    with open(base.with_suffix(".tsv"), "w") as fo:
-        fo.write(metadata)
-    with open(base.with_suffix(".fasta"), "w") as fo:
-        fo.write(fasta)
+    tsv_path = io_utils.add_compression_suffix(base.with_suffix(".tsv"), compression)
+    fasta_path = io_utils.add_compression_suffix(
+        base.with_suffix(".fasta"), compression
+    )
+    with io_utils.open_text(tsv_path, "wt", newline="") as tsv_o, io_utils.open_text(
+        fasta_path, "wt"
+    ) as fasta_o:
+        writer = csv.DictWriter(
+            tsv_o, fieldnames=models.SampleData.__fields__.keys(), delimiter="\t"
+        )
+        writer.writeheader()
+        for sample in samples:
+            with profiling.stage("writer"):
+                writer.writerow(sample.sample_data.dict())
+                fasta_o.write(f"{sample.sequence.to_fasta()}\n")
 
 
 @cli.command()
+@profile_option
 @click.option(
-    "--metadata", "-m", type=click.Path(exists=True, dir_okay=False, path_type=Path)
+    "--metadata",
+    "-m",
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=Path),
 )
 @click.option(
-    "--fasta", "-f", type=click.Path(exists=True, dir_okay=False, path_type=Path)
+    "--fasta",
+    "-f",
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=Path),
 )
-@click.option("--basename", "-b", help="Basename for output file")
-def combine_package(metadata: Path, fasta: Path, basename: str | None = None) -> None:
-    """Combine metadata tsv and fasta to a single json package"""
+@click.option("--basename", "-b", help="Basename for output file, `-` for stdout")
+@cache_option
+@click.option(
+    "--compression",
+    "-c",
+    type=click.Choice(list(io_utils.COMPRESSION_DEFAULT_SUFFIXES)),
+    help="Compress output files",
+)
+def combine_package(
+    metadata: Path,
+    fasta: Path,
+    basename: str | None = None,
+    use_cache: bool = True,
+    compression: str | None = None,
+) -> None:
+    """Combine metadata tsv and fasta to a single json package.
 
-    samples = io_utils.read_fasta_and_tsv_to_samples(
-        fasta_file=fasta, tsv_file=metadata
-    )
+    Either metadata or fasta may be `-` for stdin.
+    With basename `-` the package is streamed to stdout as JSON Lines.
+    """
+
+    base = _get_base(basename, metadata)
+    if base is None:
+        click.echo("Pass basename for stdin input", err=True)
+        return
+
+    samples = _read_fasta_and_tsv(fasta=fasta, metadata=metadata, use_cache=use_cache)
+    if samples is None:
+        click.echo("Only one of metadata and fasta can be read from stdin", err=True)
+        return
 
-    base = Path(basename) if basename else metadata
-    samples_data = [sample.export() for sample in samples]
+    if io_utils.is_stdio(base):
+        io_utils.write_jsonl_samples(samples, base)
+        return
+
+    # Stdin input is read lazily, keep reading out of the serializer stage
+    samples = list(samples)
+    with profiling.stage("serializer"):
+        samples_json = json.dumps(
+            [sample.export() for sample in samples], ensure_ascii=False
+        )
 
-    with open(base.with_suffix(".json"), "w") as fo:
-        json.dump(samples_data, fo, ensure_ascii=False)
+    json_path = io_utils.add_compression_suffix(base.with_suffix(".json"), compression)
+    with profiling.stage("writer"), io_utils.open_text(json_path, "wt") as fo:
+        fo.write(samples_json)
 
 
 @cli.command()
+@profile_option
 @click.option("--native/--no-native", help="Field names as in VGARus", default=False)
 def metadata_template(native: bool) -> None:
     """Prints tsv header for metadata"""
@@ -78,6 +244,16 @@ def metadata_template(native: bool) -> None:
 
 
 @cli.command()
+@profile_option
+def clear_cache() -> None:
+    """Remove cached validated packages"""
+
+    removed = cache.clear()
+    click.echo(f"Removed {removed} cache entries from {cache.get_cache_dir()}")
+
+
+@cli.command()
+@profile_option
 @click.option("--username", "-u")
 @click.option("--password", "-p")
 @click.option(
@@ -92,110 +268,337 @@ def dictionaries(username: str | None, password: str | None, env: Path | None) -
 
     client = service.get_client(username=username, password=password, env=env)
     if client is None:
-        click.echo("Pass username and password or env file")
+        click.echo("Pass username and password or env file", err=True)
         return
 
     dicts = client.get_dictionary()
     click.echo(json.dumps(dicts, ensure_ascii=False, indent=2))
 
 
+def upload_options(command):
+    """Adds credentials, batching and output options shared by upload commands"""
+
+    options = [
+        click.option("--username", "-u"),
+        click.option("--password", "-p"),
+        click.option(
+            "--env",
+            "-e",
+            type=click.Path(dir_okay=False, path_type=Path),
+            default=Path("~/.vgarus.env"),
+            show_default=True,
+        ),
+        click.option(
+            "--batch-size",
+            "-s",
+            type=click.IntRange(min=1),
+            help="Samples per batch, 1 by default; "
+            "upper limit with --max-batch-bytes, unbounded by default",
+        ),
+        click.option(
+            "--max-batch-bytes",
+            type=click.IntRange(min=1),
+            help="Pack batches by request size instead of sample count",
+        ),
+        click.option(
+            "--packing-window",
+            type=click.IntRange(min=1),
+            default=1,
+            show_default=True,
+            help="Samples looked ahead to fill batches by size, may reorder them",
+        ),
+        click.option(
+            "--sink",
+            type=click.Choice(sinks.SINK_KINDS),
+            default="tsv",
+            show_default=True,
+            help="Format of results and leftover outputs",
+        ),
+        click.option(
+            "--database",
+            type=click.Path(dir_okay=False, path_type=Path),
+            help="SQLite database for sqlite sink, by default next to outputs",
+        ),
+        click.option(
+            "--leftover-package",
+            type=click.Choice(sinks.LEFTOVER_PACKAGE_FORMATS),
+            help="Also write sequences of failed samples as fasta or json package",
+        ),
+        click.option(
+            "--deadline",
+            type=click.FloatRange(min=0, min_open=True),
+            help="Seconds for the whole upload, unsent samples go to leftover",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def _upload(
+    samples: Iterable[models.Sample],
+    base: Path,
+    source: Path,
+    username: str | None,
+    password: str | None,
+    env: Path | None,
+    batch_size: int | None = None,
+    max_batch_bytes: int | None = None,
+    packing_window: int = 1,
+    sink: str = "tsv",
+    database: Path | None = None,
+    leftover_package: str | None = None,
+    deadline: float | None = None,
+) -> None:
+    try:
+        result_sink = sinks.get_sink(
+            sink,
+            base=base,
+            database=database,
+            leftover_package=leftover_package,
+            source=None if io_utils.is_stdio(source) else source,
+        )
+    except ValueError as e:
+        click.echo(e, err=True)
+        return
+    if existing := result_sink.existing_outputs():
+        click.echo(f"Output path exists, change basename: {existing[0]}", err=True)
+        return
+
+    client = service.get_client(username=username, password=password, env=env)
+    if client is None:
+        click.echo("Pass username and password or env file", err=True)
+        return
+
+    batches = service.make_batches(
+        samples,
+        batch_size=batch_size,
+        max_batch_bytes=max_batch_bytes,
+        packing_window=packing_window,
+    )
+
+    with tqdm(
+        desc="Uploading",
+        # Streamed samples are batched on the fly, so the total is unknown
+        total=len(batches) if isinstance(batches, list) else None,
+    ) as progress, logging_redirect_tqdm(), result_sink:
+
+        def on_batch(ok: int, not_ok: int) -> None:
+            progress.set_postfix(ok=ok, not_ok=not_ok)
+            progress.update()
+
+        service.upload_samples_to_sink(
+            client,
+            batches=batches,
+            sink=result_sink,
+            on_batch=on_batch,
+            deadline=deadline,
+        )
+
+
 @cli.command()
+@profile_option
 @click.option(
-    "--package", "-j", type=click.Path(exists=True, dir_okay=False, path_type=Path)
-)
-@click.option(
-    "--metadata", "-m", type=click.Path(exists=True, dir_okay=False, path_type=Path)
+    "--package",
+    "-j",
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=Path),
 )
 @click.option(
-    "--fasta", "-f", type=click.Path(exists=True, dir_okay=False, path_type=Path)
+    "--metadata",
+    "-m",
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=Path),
 )
-@click.option("--username", "-u")
-@click.option("--password", "-p")
 @click.option(
-    "--env",
-    "-e",
-    type=click.Path(dir_okay=False, path_type=Path),
-    default=Path("~/.vgarus.env"),
-    show_default=True,
+    "--fasta",
+    "-f",
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=Path),
 )
-@click.option("--batch-size", "-s", type=int, default=1, show_default=True)
-@click.option("--basename", "-b", help="Basename for outputs")
+@click.option("--basename", "-b", help="Basename for outputs, `-` for stdout")
+@cache_option
+@upload_options
 def upload(
     package: Path | None,
     metadata: Path | None,
     fasta: Path | None,
-    username: str | None,
-    password: str | None,
-    env: Path | None,
-    batch_size: int = 1,
     basename: str | None = None,
+    use_cache: bool = True,
+    **options,
 ) -> None:
-    """Upload to VGARUS"""
+    """Upload to VGARUS.
 
+    Package `-` is streamed from stdin as JSON Lines, either metadata or fasta
+    may be `-` too. With basename `-` results are streamed to stdout.
+    Leftover metadata (.leftover.tsv) is read without the sample cache,
+    hashing the whole original fasta costs more than the few samples left.
+    """
+
+    samples: Iterable[models.Sample] | None
     if package is not None and metadata is None and fasta is None:
-        samples = io_utils.read_json_to_samples(package)
-        base = Path(basename) if basename else package.with_suffix("")
+        samples = _read_package(package, use_cache=use_cache)
+        source = package
     elif package is None and metadata is not None and fasta is not None:
-        samples = io_utils.read_fasta_and_tsv_to_samples(
-            fasta_file=fasta, tsv_file=metadata
+        if use_cache and _is_leftover(metadata):
+            logger.info("Sample cache is not used for leftover metadata")
+            use_cache = False
+        samples = _read_fasta_and_tsv(
+            fasta=fasta, metadata=metadata, use_cache=use_cache
         )
-        base = Path(basename) if basename else metadata.with_suffix("")
+        source = metadata
     else:
-        click.echo("Specify package or metadata with fasta")
+        click.echo("Specify package or metadata with fasta", err=True)
         return
 
-    results_path = base.with_suffix(".result.tsv")
-    if results_path.exists():
-        click.echo(f"Result path exists, change basename: {results_path}")
+    if samples is None:
+        click.echo("Only one of metadata and fasta can be read from stdin", err=True)
         return
-
-    leftover_path = base.with_suffix(".leftover.tsv")
-    if leftover_path.exists():
-        click.echo(f"Leftover path exists, change basename: {results_path}")
+    base = _get_base(basename, source)
+    if base is None:
+        click.echo("Pass basename for stdin input", err=True)
         return
 
-    client = service.get_client(username=username, password=password, env=env)
-    if client is None:
-        click.echo("Pass username and password or env file")
-        return
+    _upload(samples, base, source, **options)
 
-    batch_number = math.ceil(len(samples) / batch_size)
 
-    ok, not_ok = 0, 0
-    with tqdm(
-        desc="Uploading", total=batch_number
-    ) as progress, logging_redirect_tqdm(), open(results_path, "w") as results_o, open(
-        leftover_path, "w"
-    ) as leftover_o:
-        results_writer = csv.DictWriter(
-            results_o,
-            fieldnames=models.UploadResult.__fields__.keys(),
-            delimiter="\t",
-        )
-        leftover_writer = csv.DictWriter(
-            leftover_o,
-            fieldnames=models.SampleData.__fields__.keys(),
-            delimiter="\t",
+@cli.command()
+@profile_option
+@click.argument(
+    "leftover",
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=Path),
+)
+@click.option(
+    "--fasta",
+    "-f",
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=Path),
+    help="Original fasta, by default leftover fasta package next to leftover",
+)
+@click.option("--basename", "-b", help="Basename for outputs, `-` for stdout")
+@upload_options
+def retry_leftover(
+    leftover: Path,
+    fasta: Path | None = None,
+    basename: str | None = None,
+    **options,
+) -> None:
+    """Upload samples from leftover metadata again.
+
+    Only sequences of leftover samples are read from the fasta by its index,
+    samples are streamed without the cache that would hash the whole fasta.
+    Outputs are named as .leftover.result.tsv etc.
+    """
+
+    if io_utils.is_stdio(leftover):
+        if fasta is None or basename is None:
+            click.echo("Pass fasta and basename for stdin input", err=True)
+            return
+        base = Path(basename)
+    else:
+        leftover_base = io_utils.get_basename(leftover)
+        base = (
+            Path(basename)
+            if basename
+            else leftover_base.with_name(f"{leftover_base.name}.retry")
         )
-        results_writer.writeheader()
-        leftover_writer.writeheader()
-
-        for result, batch in service.upload_samples(
-            client, samples=samples, batch_size=batch_size
-        ):
-            for upload_result, sample in zip(result, batch):
-                if upload_result.ok:
-                    ok += 1
-                    results_writer.writerow(upload_result.dict())
-                else:
-                    not_ok += 1
-                    leftover_writer.writerow(sample.sample_data.dict())
+        if fasta is None:
+            fasta = leftover_base.with_suffix(".leftover.fasta")
+            if not fasta.exists():
+                click.echo(
+                    f"Pass fasta, leftover fasta package not found: {fasta}", err=True
+                )
+                return
+
+    if io_utils.is_stdio(leftover) and io_utils.is_stdio(fasta):
+        click.echo("Only one of leftover and fasta can be read from stdin", err=True)
+        return
+
+    samples = io_utils.iter_fasta_and_tsv_to_samples(
+        fasta_file=fasta, tsv_file=leftover
+    )
+    _upload(samples, base, leftover, **options)
 
-            progress.set_postfix(ok=ok, not_ok=not_ok)
-            progress.update()
 
-    if not_ok == 0:
-        leftover_path.unlink()
+@cli.command()
+@profile_option
+@click.argument(
+    "directories",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+)
+@click.option(
+    "--queue",
+    "-q",
+    "queue_path",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=Path("~/.vgarus.queue.sqlite"),
+    show_default=True,
+    help="Persistent job queue database",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of jobs uploaded at once",
+)
+@click.option(
+    "--interval",
+    "-i",
+    type=click.FloatRange(min=0),
+    default=10,
+    show_default=True,
+    help="Seconds between directory scans",
+)
+@click.option(
+    "--settle",
+    type=click.FloatRange(min=0),
+    default=10,
+    show_default=True,
+    help="Skip files modified less recently, they may be still being copied",
+)
+@click.option("--once", is_flag=True, help="Exit when the queue is drained")
+@cache_option
+@upload_options
+def watch(
+    directories: tuple[Path, ...],
+    queue_path: Path,
+    username: str | None,
+    password: str | None,
+    env: Path | None,
+    workers: int = 1,
+    interval: float = 10,
+    settle: float = 10,
+    once: bool = False,
+    **job_options,
+) -> None:
+    """Watch directories and upload new packages or metadata with fasta"""
+
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    client = service.get_client(
+        username=username, password=password, env=env, session=session
+    )
+    if client is None:
+        click.echo("Pass username and password or env file", err=True)
+        return
+
+    queue = jobs.JobQueue(queue_path.expanduser())
+    try:
+        jobs.watch(
+            client,
+            queue=queue,
+            directories=list(directories),
+            workers=workers,
+            interval=interval,
+            settle=settle,
+            once=once,
+            **job_options,
+        )
+    except KeyboardInterrupt:
+        logger.info("Stopped")
+    finally:
+        queue.close()
+        session.close()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,12 @@
 import json
 import logging
+import threading
+import time
 
 import requests
 import requests.auth
 
-from . import models
+from . import models, profiling
 
 logger = logging.getLogger("vgarus")
 
@@ -13,31 +15,91 @@ class VgarusClient:
     UPLOAD_URL: str = "https://genome.crie.ru/api/v1/import/package"
     DICTIONARY_URL: str = "https://genome.crie.ru/api/v1/import/dictionary"
 
-    TIMEOUT: int = 60
+    CONNECT_TIMEOUT: float = 10
+    # Read timeout until server throughput is observed
+    READ_TIMEOUT: float = 60
+    MIN_READ_TIMEOUT: float = 15
+    MAX_READ_TIMEOUT: float = 600
+    # Margin over the expected upload duration before giving up
+    READ_TIMEOUT_FACTOR: float = 4
+    THROUGHPUT_SMOOTHING: float = 0.3
 
-    def __init__(self, auth: models.VgarusAuth) -> None:
+    def __init__(
+        self, auth: models.VgarusAuth, session: requests.Session | None = None
+    ) -> None:
         self.auth = requests.auth.HTTPBasicAuth(
             username=auth.username, password=auth.password
         )
+        # Shared session keeps connections alive between requests
+        self.session = session
+        # Exponential moving average of uploaded bytes per second
+        self.throughput: float | None = None
+        self._throughput_lock = threading.Lock()
+
+    def get_read_timeout(self, payload_bytes: int) -> float:
+        """Read timeout scaled from payload size and observed throughput"""
+
+        if self.throughput is None or not payload_bytes:
+            return self.READ_TIMEOUT
+        expected = payload_bytes / self.throughput
+        return min(
+            self.MAX_READ_TIMEOUT,
+            max(self.MIN_READ_TIMEOUT, expected * self.READ_TIMEOUT_FACTOR),
+        )
+
+    def _update_throughput(self, payload_bytes: int, elapsed: float) -> None:
+        if not payload_bytes or elapsed <= 0:
+            return
+        observed = payload_bytes / elapsed
+        with self._throughput_lock:
+            if self.throughput is None:
+                self.throughput = observed
+            else:
+                self.throughput += self.THROUGHPUT_SMOOTHING * (
+                    observed - self.throughput
+                )
 
     def _send_request(
-        self, method: str, url: str, data: list[dict] | None = None
+        self,
+        method: str,
+        url: str,
+        data: list[dict] | None = None,
+        max_timeout: float | None = None,
     ) -> dict | None:
+        """Sends request, timeouts are capped by max_timeout seconds if set.
+
+        Read timeout limits waiting for each chunk of the response,
+        so a response trickling in can take longer in total.
+        """
+
         logger.debug(
             "Sending %s to %s, data length: %s", method, url, len(data) if data else 0
         )
+        request = self.session.request if self.session else requests.request
         try:
-            response = requests.request(
-                method=method,
-                url=url,
-                json=data,
-                auth=self.auth,
-                timeout=self.TIMEOUT,
-            )
-            logger.debug("Status: %s", response.status_code)
-            logger.debug("Response: %s", response.text)
-            response.raise_for_status()
-            return response.json()
+            with profiling.stage("serializer"):
+                body = json.dumps(data).encode() if data is not None else None
+            payload_bytes = len(body) if body else 0
+            connect_timeout = self.CONNECT_TIMEOUT
+            read_timeout = self.get_read_timeout(payload_bytes)
+            if max_timeout is not None:
+                connect_timeout = min(connect_timeout, max_timeout)
+                read_timeout = min(read_timeout, max_timeout)
+            with profiling.stage("http"):
+                started = time.perf_counter()
+                response = request(
+                    method=method,
+                    url=url,
+                    data=body,
+                    headers={"Content-Type": "application/json"} if body else None,
+                    auth=self.auth,
+                    timeout=(connect_timeout, read_timeout),
+                )
+                logger.debug("Status: %s", response.status_code)
+                logger.debug("Response: %s", response.text)
+                response.raise_for_status()
+                self._update_throughput(payload_bytes, time.perf_counter() - started)
+                return response.json()
         except json.JSONDecodeError as e:
             logging.error("JSON decoding error: %s", e)
         except requests.RequestException as e:
@@ -52,9 +114,14 @@ class VgarusClient:
         res = self._send_request("GET", self.DICTIONARY_URL)
         return res or {}
 
-    def send_batch(self, batch: list[models.Sample]) -> models.VgarusResponse:
-        data = [sample.export() for sample in batch]
-        response_data = self._send_request("POST", self.UPLOAD_URL, data)
+    def send_batch(
+        self, batch: list[models.Sample], max_timeout: float | None = None
+    ) -> models.VgarusResponse:
+        with profiling.stage("serializer"):
+            data = [sample.export() for sample in batch]
+        response_data = self._send_request(
+            "POST", self.UPLOAD_URL, data, max_timeout=max_timeout
+        )
 
         if response_data is None:
             raise ValueError("No response")
@@ -1,4 +1,4 @@
-from enum import IntEnum
+from enum import Enum, IntEnum
 
 
 class Specimen(IntEnum):
@@ -67,3 +67,10 @@ class Travel(IntEnum):
 class Reinfection(IntEnum):
     NO = 0
     YES = 1
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
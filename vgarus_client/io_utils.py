@@ -1,63 +1,430 @@
+import contextlib
 import csv
+import gzip
 import io
+import json
 import logging
+import os
+import sys
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Generator
+from typing import IO, Callable, ContextManager, Generator, Iterable
 
 import pyfastx
-from pydantic import parse_file_as
+from pydantic import parse_obj_as
 
-from . import models
+from . import cache, models, profiling, utils
 
 logger = logging.getLogger("vgarus")
 
+GZIP_MAGIC = b"\x1f\x8b"
+# gzip header of a BGZF block: deflate method with extra field
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_THREADS = min(4, os.cpu_count() or 1)
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 
-def iter_fasta(fasta_file: Path) -> Generator[models.Sequence, None, None]:
-    fa = pyfastx.Fastx(str(fasta_file))
-    for name, seq in fa:
-        yield models.Sequence(header=name, body=seq)
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".bgz": "gzip", ".zst": "zstd"}
+COMPRESSION_DEFAULT_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
 
+STDIO = Path("-")
 
-def iter_sample_data(tsv_file: Path) -> Generator[models.SampleData, None, None]:
-    with open(tsv_file, "r") as fi:
-        reader = csv.DictReader(fi, delimiter="\t")
-        for row in reader:
-            yield models.SampleData.parse_obj(row)
 
+def is_stdio(path: Path) -> bool:
+    """Whether path is `-` meaning stdin or stdout"""
 
-def read_json_to_samples(json_file: Path) -> list[models.Sample]:
-    return parse_file_as(list[models.Sample], json_file)
+    return path == STDIO
 
 
-def read_fasta_and_tsv_to_samples(
-    fasta_file: Path, tsv_file: Path
-) -> list[models.Sample]:
-    sequences = {sequence.header: sequence for sequence in iter_fasta(fasta_file)}
-    samples: list[models.Sample] = []
-    for data in iter_sample_data(tsv_file):
-        if data.virus_name not in sequences:
+def is_jsonl(path: Path) -> bool:
+    """Standard streams and .jsonl files hold one sample per line"""
+
+    return is_stdio(path) or strip_compression_suffix(path).suffix == ".jsonl"
+
+
+def detect_compression(path: Path) -> str | None:
+    """Detects compression by magic bytes, bgzip is detected as gzip"""
+
+    with open(path, "rb") as fi:
+        magic = fi.read(len(ZSTD_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+def strip_compression_suffix(path: Path) -> Path:
+    if path.suffix in COMPRESSION_SUFFIXES:
+        return path.with_suffix("")
+    return path
+
+
+def get_basename(path: Path) -> Path:
+    """Basename for outputs: input path without extension and compression"""
+
+    return strip_compression_suffix(path).with_suffix("")
+
+
+def add_compression_suffix(path: Path, compression: str | None) -> Path:
+    if compression is None:
+        return path
+    return path.with_name(path.name + COMPRESSION_DEFAULT_SUFFIXES[compression])
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise RuntimeError(
+            "zstd support requires zstandard, install vgarus-client[zstd]"
+        ) from e
+    return zstandard
+
+
+def is_bgzf(path: Path) -> bool:
+    """Whether gzip file is made of independent BGZF blocks"""
+
+    with open(path, "rb") as fi:
+        header = fi.read(14)
+    return header.startswith(BGZF_MAGIC) and header[12:14] == b"BC"
+
+
+def _read_bgzf_block(fi: IO[bytes]) -> bytes | None:
+    """Reads compressed data of the next block followed by its CRC32 and size"""
+
+    header = fi.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or not header.startswith(BGZF_MAGIC):
+        raise ValueError("Not a BGZF block")
+    extra = fi.read(int.from_bytes(header[10:12], "little"))
+
+    block_size = None
+    i = 0
+    while i + 4 <= len(extra):
+        field_size = int.from_bytes(extra[i + 2 : i + 4], "little")
+        if extra[i : i + 2] == b"BC":
+            block_size = int.from_bytes(extra[i + 4 : i + 6], "little") + 1
+        i += 4 + field_size
+    if block_size is None:
+        raise ValueError("BGZF block size is missing")
+
+    data = fi.read(block_size - len(header) - len(extra))
+    if len(data) < 8:
+        raise ValueError("BGZF block is truncated")
+    return data
+
+
+def _inflate_bgzf_block(data: bytes) -> bytes:
+    block = zlib.decompress(data[:-8], wbits=-15)
+    crc, size = int.from_bytes(data[-8:-4], "little"), int.from_bytes(
+        data[-4:], "little"
+    )
+    if len(block) != size or zlib.crc32(block) != crc:
+        raise ValueError("BGZF block is corrupted")
+    return block
+
+
+class BgzfReader(io.RawIOBase):
+    """Reads BGZF file decompressing blocks ahead in a thread pool.
+
+    Blocks are independent deflate streams and zlib releases the GIL,
+    so decompression scales with threads while blocks are read in order.
+    """
+
+    def __init__(self, path: Path, threads: int = BGZF_THREADS) -> None:
+        self._fi = open(path, "rb")
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._pending: deque[Future[bytes]] = deque()
+        self._read_ahead = 4 * threads
+        self._block = b""
+        self._offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _submit_blocks(self) -> None:
+        while len(self._pending) < self._read_ahead:
+            data = _read_bgzf_block(self._fi)
+            if data is None:
+                return
+            self._pending.append(self._executor.submit(_inflate_bgzf_block, data))
+
+    def readinto(self, buffer) -> int:
+        # The last block of a BGZF file is empty
+        while self._offset >= len(self._block):
+            self._submit_blocks()
+            if not self._pending:
+                return 0
+            self._block = self._pending.popleft().result()
+            self._offset = 0
+
+        size = min(len(buffer), len(self._block) - self._offset)
+        buffer[:size] = self._block[self._offset : self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self._executor.shutdown(cancel_futures=True)
+            self._fi.close()
+        super().close()
+
+
+def open_text(
+    path: Path, mode: str = "rt", newline: str | None = None
+) -> ContextManager[IO[str]]:
+    """Opens plain, gzip/bgzip or zstd text file, or stdin/stdout for `-`.
+
+    Compression is detected by magic bytes for reading
+    and by file suffix for writing. Standard streams are left open.
+    Pass `newline=""` for csv files to keep line breaks inside fields.
+    """
+
+    if is_stdio(path):
+        return contextlib.nullcontext(sys.stdin if "r" in mode else sys.stdout)
+
+    if "r" in mode:
+        compression = detect_compression(path)
+    else:
+        compression = COMPRESSION_SUFFIXES.get(path.suffix)
+
+    if compression == "gzip" and "r" in mode and is_bgzf(path):
+        return io.TextIOWrapper(io.BufferedReader(BgzfReader(path)), newline=newline)
+    if compression == "gzip":
+        return gzip.open(path, mode, newline=newline)  # type: ignore
+    if compression == "zstd":
+        zstandard = _import_zstandard()
+        # Compression can use all cores, zstd frames are decompressed sequentially
+        cctx = zstandard.ZstdCompressor(threads=-1) if "w" in mode else None
+        return zstandard.open(path, mode, cctx=cctx, newline=newline)
+    return open(path, mode, newline=newline)
+
+
+def _iter_fasta_records(lines: Iterable[str]) -> Generator[tuple[str, str], None, None]:
+    name: str | None = None
+    body: list[str] = []
+    for line in lines:
+        if line.startswith(">"):
+            if name is not None:
+                yield name, "".join(body)
+            # Same as pyfastx: name is the header up to the first whitespace
+            name = next(iter(line[1:].split(maxsplit=1)), "")
+            body = []
+        elif name is not None:
+            body.append(line.strip())
+    if name is not None:
+        yield name, "".join(body)
+
+
+def _is_pyfastx_readable(fasta_file: Path) -> bool:
+    # pyfastx reads plain and gzip files natively, but not zstd or streams
+    return not is_stdio(fasta_file) and detect_compression(fasta_file) != "zstd"
+
+
+class FastaIndex:
+    """Index of a fasta file by normalized sequence names.
+
+    Built in one pass over pyfastx keys, sequences are read only on access.
+    pyfastx index is kept in the cache directory and reused between runs.
+    Names colliding after normalization are reported and never resolved.
+    """
+
+    def __init__(self, fasta_file: Path) -> None:
+        with profiling.stage("reader"):
+            self._build(fasta_file)
+
+    def _build(self, fasta_file: Path) -> None:
+        self.fasta_file = fasta_file
+        self._fasta: pyfastx.Fasta | list[tuple[str, str]]
+        if not _is_pyfastx_readable(fasta_file):
+            # Sequences from zstd files and stdin are kept in memory
+            with open_text(fasta_file) as fi:
+                self._fasta = list(_iter_fasta_records(fi))
+            names = [name for name, _ in self._fasta]
+        else:
+            self._fasta = self._open_pyfastx(fasta_file)
+            names = list(self._fasta.keys())
+
+        self.offsets: dict[str, int] = {}
+        self.collisions: dict[str, list[str]] = {}
+        for offset, name in enumerate(names):
+            normalized = utils.normalize_name(name)
+            if normalized in self.collisions:
+                self.collisions[normalized].append(name)
+            elif normalized in self.offsets:
+                first = names[self.offsets.pop(normalized)]
+                self.collisions[normalized] = [first, name]
+            else:
+                self.offsets[normalized] = offset
+
+        if self.collisions:
             logger.warning(
-                "Virus name from metadata not found in fasta: %s", data.virus_name
-            )
-            continue
-        samples.append(
-            models.Sample.construct(
-                sample_data=data, sequence=sequences[data.virus_name]
+                "%s names in %s collide after normalization and will be skipped: %s",
+                len(self.collisions),
+                fasta_file,
+                "; ".join(
+                    f"{normalized}: {', '.join(names)}"
+                    for normalized, names in self.collisions.items()
+                ),
             )
-        )
+
+    @staticmethod
+    def _open_pyfastx(fasta_file: Path) -> pyfastx.Fasta:
+        index_path = cache.get_fasta_index_path(fasta_file)
+        try:
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            logger.warning("Can't store fasta index in %s: %s", index_path, e)
+            return pyfastx.Fasta(str(fasta_file), memory_index=True)
+        if index_path.exists():
+            # Reused index is kept by the cache size limit
+            index_path.touch()
+        return pyfastx.Fasta(str(fasta_file), index_file=str(index_path))
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.offsets
+
+    def get(self, name: str) -> models.Sequence | None:
+        """Gets sequence by normalized name"""
+
+        offset = self.offsets.get(name)
+        if offset is None:
+            return None
+        with profiling.stage("reader"):
+            if isinstance(self._fasta, list):
+                header, body = self._fasta[offset]
+            else:
+                record = self._fasta[offset]
+                header, body = record.name, record.seq
+        with profiling.stage("validator"):
+            return models.Sequence(header=header, body=body)
+
+
+def iter_sample_data(tsv_file: Path) -> Generator[models.SampleData, None, None]:
+    """Reads metadata from tsv or, for .jsonl files, from JSON Lines"""
+
+    with open_text(tsv_file, newline="") as fi:
+        reader: Iterable[dict]
+        if strip_compression_suffix(tsv_file).suffix == ".jsonl":
+            reader = (json.loads(line) for line in fi if line.strip())
+        else:
+            reader = csv.DictReader(fi, delimiter="\t")
+        for row in profiling.iter_stage(reader, "reader"):
+            with profiling.stage("validator"):
+                data = models.SampleData.parse_obj(row)
+            yield data
+
+
+class _WarningCollector(logging.Handler):
+    """Collects warnings logged by the current thread"""
+
+    def __init__(self) -> None:
+        super().__init__(logging.WARNING)
+        self.thread = threading.get_ident()
+        self.messages: list[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.thread == self.thread:
+            self.messages.append(record.getMessage())
+
+
+def _read_cached(
+    read: Callable[[], list[models.Sample]], files: list[Path], use_cache: bool
+) -> list[models.Sample]:
+    if not use_cache or any(is_stdio(file) for file in files):
+        return read()
+
+    with profiling.stage("cache"):
+        key = cache.get_key(*files)
+        samples = cache.load(key)
+    if samples is None:
+        # Warnings about dropped samples are stored to be repeated on cache hits
+        collector = _WarningCollector()
+        logger.addHandler(collector)
+        try:
+            samples = read()
+        finally:
+            logger.removeHandler(collector)
+        with profiling.stage("cache"):
+            cache.store(key, samples, warnings=collector.messages)
     return samples
 
 
-def samples_to_tsv(samples: list[models.Sample]) -> str:
-    with io.StringIO() as buffer:
-        writer = csv.DictWriter(
-            buffer, fieldnames=models.SampleData.__fields__.keys(), delimiter="\t"
-        )
-        writer.writeheader()
-        writer.writerows(sample.sample_data.dict() for sample in samples)
-        return buffer.getvalue()
+def read_json_to_samples(
+    json_file: Path, use_cache: bool = False
+) -> list[models.Sample]:
+    return _read_cached(
+        lambda: _read_json_to_samples(json_file),
+        files=[json_file],
+        use_cache=use_cache,
+    )
+
+
+def _read_json_to_samples(json_file: Path) -> list[models.Sample]:
+    if is_jsonl(json_file):
+        return list(iter_jsonl_samples(json_file))
+
+    with profiling.stage("reader"), open_text(json_file) as fi:
+        raw = json.load(fi)
+    with profiling.stage("validator"):
+        return parse_obj_as(list[models.Sample], raw)
+
+
+def iter_jsonl_samples(json_file: Path) -> Generator[models.Sample, None, None]:
+    """Reads samples in the exported form, one per line"""
 
+    with open_text(json_file) as fi:
+        for line in profiling.iter_stage(fi, "reader"):
+            if not line.strip():
+                continue
+            with profiling.stage("validator"):
+                sample = models.Sample.parse_raw(line)
+            yield sample
 
-def samples_to_fasta(samples: list[models.Sample]) -> str:
-    return "\n".join(sample.sequence.to_fasta() for sample in samples)
 
+def write_jsonl_samples(samples: Iterable[models.Sample], json_file: Path) -> None:
+    with open_text(json_file, "wt") as fo:
+        for sample in samples:
+            with profiling.stage("serializer"):
+                line = json.dumps(sample.export(), ensure_ascii=False)
+            with profiling.stage("writer"):
+                fo.write(f"{line}\n")
+        fo.flush()
+
+
+def read_fasta_and_tsv_to_samples(
+    fasta_file: Path, tsv_file: Path, use_cache: bool = False
+) -> list[models.Sample]:
+    return _read_cached(
+        lambda: list(iter_fasta_and_tsv_to_samples(fasta_file, tsv_file)),
+        files=[fasta_file, tsv_file],
+        use_cache=use_cache,
+    )
+
+
+def iter_fasta_and_tsv_to_samples(
+    fasta_file: Path, tsv_file: Path
+) -> Generator[models.Sample, None, None]:
+    index = FastaIndex(fasta_file)
+    not_found: list[str] = []
+    for data in iter_sample_data(tsv_file):
+        sequence = index.get(data.virus_name)
+        if sequence is None:
+            if data.virus_name not in index.collisions:
+                not_found.append(data.virus_name)
+            continue
+        yield models.Sample.construct(sample_data=data, sequence=sequence)
+
+    if not_found:
+        logger.warning(
+            "%s virus names from metadata not found in fasta: %s",
+            len(not_found),
+            ", ".join(not_found),
+        )
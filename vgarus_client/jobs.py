@@ -0,0 +1,383 @@
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from vgarus_client import client, enums, io_utils, models, service, sinks
+
+logger = logging.getLogger("vgarus")
+
+PACKAGE_SUFFIXES = (".json",)
+METADATA_SUFFIXES = (".tsv",)
+FASTA_SUFFIXES = (".fasta", ".fa", ".fas", ".fna")
+OUTPUT_SUFFIXES = (".result", ".leftover")
+# Running jobs without a heartbeat for this long belong to a dead process
+STALE_AFTER = 300
+
+CREATE_JOBS_TABLE = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL UNIQUE,
+    package TEXT,
+    metadata TEXT,
+    fasta TEXT,
+    fingerprint TEXT,
+    status TEXT NOT NULL,
+    ok INTEGER NOT NULL DEFAULT 0,
+    not_ok INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    owner TEXT,
+    heartbeat TEXT,
+    run TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    revision INTEGER NOT NULL DEFAULT 0,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL
+)
+"""
+
+
+def _get_fingerprint(job: models.UploadJob) -> str:
+    """Size and modification time of the job input files"""
+
+    stats = [path.stat() for path in (job.package, job.metadata, job.fasta) if path]
+    return ",".join(f"{stat.st_size}:{stat.st_mtime_ns}" for stat in stats)
+
+
+class JobQueue:
+    """Persistent upload job queue in a SQLite database.
+
+    Running jobs are owned by the queue that took them, so several
+    processes may share one database. Owners keep a heartbeat on their
+    jobs and only jobs with a stale heartbeat are requeued.
+    """
+
+    def __init__(self, path: Path, owner: str | None = None) -> None:
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute(CREATE_JOBS_TABLE)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> models.UploadJob:
+        return models.UploadJob(
+            id=row["id"],
+            package=row["package"],
+            metadata=row["metadata"],
+            fasta=row["fasta"],
+            status=row["status"],
+            ok=row["ok"],
+            not_ok=row["not_ok"],
+            error=row["error"],
+            run=row["run"],
+            attempts=row["attempts"],
+            revision=row["revision"],
+        )
+
+    def enqueue(self, job: models.UploadJob) -> bool:
+        """Adds job unless a job for the same source exists.
+
+        A finished job whose input files changed since is enqueued again
+        as the next revision, a pending one is updated to the new files.
+        """
+
+        now = datetime.now().isoformat()
+        cursor = self.connection.execute(
+            "INSERT INTO jobs "
+            "(source, package, metadata, fasta, fingerprint, status, run, "
+            "created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (source) DO UPDATE SET "
+            "package = excluded.package, metadata = excluded.metadata, "
+            "fasta = excluded.fasta, fingerprint = excluded.fingerprint, "
+            "revision = revision + (status != excluded.status), "
+            "status = excluded.status, run = excluded.run, ok = 0, not_ok = 0, "
+            "error = NULL, attempts = 0, owner = NULL, updated = excluded.updated "
+            "WHERE fingerprint IS NOT excluded.fingerprint "
+            "AND (status IN (?, ?) OR (status = ? AND attempts = 0))",
+            (
+                str(job.source.resolve()),
+                str(job.package.resolve()) if job.package else None,
+                str(job.metadata.resolve()) if job.metadata else None,
+                str(job.fasta.resolve()) if job.fasta else None,
+                _get_fingerprint(job),
+                enums.JobStatus.PENDING.value,
+                uuid.uuid4().hex,
+                now,
+                now,
+                enums.JobStatus.DONE.value,
+                enums.JobStatus.FAILED.value,
+                enums.JobStatus.PENDING.value,
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def take(self) -> models.UploadJob | None:
+        """Marks the oldest pending job as running by this queue and returns it"""
+
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                (enums.JobStatus.PENDING.value,),
+            ).fetchone()
+            if row is not None:
+                now = datetime.now().isoformat()
+                self.connection.execute(
+                    "UPDATE jobs SET status = ?, owner = ?, heartbeat = ?, updated = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    (enums.JobStatus.RUNNING.value, self.owner, now, now, row["id"]),
+                )
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        job = self._to_job(row)
+        job.status = enums.JobStatus.RUNNING
+        job.attempts += 1
+        return job
+
+    def update(self, job: models.UploadJob) -> bool:
+        """Updates job owned by this queue, returns whether it was updated"""
+
+        cursor = self.connection.execute(
+            "UPDATE jobs SET status = ?, ok = ?, not_ok = ?, error = ?, updated = ? "
+            "WHERE id = ? AND owner = ?",
+            (
+                enums.JobStatus(job.status).value,
+                job.ok,
+                job.not_ok,
+                job.error,
+                datetime.now().isoformat(),
+                job.id,
+                self.owner,
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def heartbeat(self) -> None:
+        """Marks jobs running by this queue as alive"""
+
+        self.connection.execute(
+            "UPDATE jobs SET heartbeat = ? WHERE status = ? AND owner = ?",
+            (datetime.now().isoformat(), enums.JobStatus.RUNNING.value, self.owner),
+        )
+
+    def requeue_stale(self, stale_after: float = STALE_AFTER) -> int:
+        """Returns jobs of other owners without a recent heartbeat to pending"""
+
+        cutoff = datetime.now() - timedelta(seconds=stale_after)
+        cursor = self.connection.execute(
+            "UPDATE jobs SET status = ?, owner = NULL, updated = ? "
+            "WHERE status = ? AND owner IS NOT ? "
+            "AND (heartbeat IS NULL OR heartbeat < ?)",
+            (
+                enums.JobStatus.PENDING.value,
+                datetime.now().isoformat(),
+                enums.JobStatus.RUNNING.value,
+                self.owner,
+                cutoff.isoformat(),
+            ),
+        )
+        return cursor.rowcount
+
+    def get_jobs(self, status: enums.JobStatus | None = None) -> list[models.UploadJob]:
+        if status is None:
+            rows = self.connection.execute("SELECT * FROM jobs ORDER BY id")
+        else:
+            rows = self.connection.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY id", (status.value,)
+            )
+        return [self._to_job(row) for row in rows]
+
+
+def _is_settled(path: Path, settle: float) -> bool:
+    return time.time() - path.stat().st_mtime >= settle
+
+
+def _find_fasta(base: Path, settle: float) -> Path | None:
+    for suffix in FASTA_SUFFIXES:
+        for compression_suffix in ("", *io_utils.COMPRESSION_SUFFIXES):
+            path = base.with_name(base.name + suffix + compression_suffix)
+            if path.is_file() and _is_settled(path, settle):
+                return path
+    return None
+
+
+def scan(directory: Path, settle: float = 0) -> list[models.UploadJob]:
+    """Finds json packages and tsv with fasta pairs in a directory.
+
+    Files modified less than `settle` seconds ago are skipped
+    as they may be still being written.
+    """
+
+    jobs = []
+    for path in sorted(directory.iterdir()):
+        if not path.is_file() or not _is_settled(path, settle):
+            continue
+        plain = io_utils.strip_compression_suffix(path)
+        if plain.with_suffix("").suffix in OUTPUT_SUFFIXES:
+            continue
+        if plain.suffix in PACKAGE_SUFFIXES:
+            jobs.append(models.UploadJob(package=path))
+        elif plain.suffix in METADATA_SUFFIXES:
+            fasta = _find_fasta(plain.with_suffix(""), settle)
+            if fasta is not None:
+                jobs.append(models.UploadJob(metadata=path, fasta=fasta))
+    return jobs
+
+
+def run_job(
+    client: client.VgarusClient,
+    job: models.UploadJob,
+    batch_size: int | None = None,
+    max_batch_bytes: int | None = None,
+    packing_window: int = 1,
+    use_cache: bool = True,
+    sink: str = "tsv",
+    database: Path | None = None,
+    leftover_package: str | None = None,
+    deadline: float | None = None,
+) -> tuple[int, int]:
+    """Uploads job samples, results are written next to the job source.
+
+    A job taken again after an interruption continues its own outputs
+    and skips samples written by the earlier attempts. A job enqueued again
+    after its input changed moves outputs of the previous revision aside.
+    """
+
+    if job.package is not None:
+        samples = io_utils.read_json_to_samples(job.package, use_cache=use_cache)
+    elif job.metadata is not None and job.fasta is not None:
+        samples = io_utils.read_fasta_and_tsv_to_samples(
+            fasta_file=job.fasta, tsv_file=job.metadata, use_cache=use_cache
+        )
+    else:
+        raise ValueError("Job has neither package nor metadata with fasta")
+
+    result_sink = sinks.get_sink(
+        sink,
+        base=io_utils.get_basename(job.source),
+        database=database,
+        leftover_package=leftover_package,
+        source=job.source,
+        run=job.run,
+    )
+    uploaded: set[str] = set()
+    failed: set[str] = set()
+    if job.attempts > 1:
+        uploaded, failed = result_sink.resume()
+    elif existing := result_sink.existing_outputs():
+        if not job.revision:
+            raise FileExistsError(f"Output path exists: {existing[0]}")
+        # Outputs of the previous revision are kept next to the new ones
+        for path in existing:
+            path.rename(path.with_name(f"{path.name}.{job.revision - 1}"))
+    if uploaded or failed:
+        logger.info(
+            "Job %s resumed: skipping %s uploaded and %s failed samples",
+            job.id,
+            len(uploaded),
+            len(failed),
+        )
+        written = uploaded | failed
+        samples = [
+            sample for sample in samples if sample.sample_data.virus_name not in written
+        ]
+
+    batches = service.make_batches(
+        samples,
+        batch_size=batch_size,
+        max_batch_bytes=max_batch_bytes,
+        packing_window=packing_window,
+    )
+    with result_sink:
+        ok, not_ok = service.upload_samples_to_sink(
+            client, batches=batches, sink=result_sink, deadline=deadline
+        )
+    return ok + len(uploaded), not_ok + len(failed)
+
+
+def _finish(queue: JobQueue, job: models.UploadJob, future: Future) -> None:
+    try:
+        job.ok, job.not_ok = future.result()
+        job.status = enums.JobStatus.DONE
+        logger.info("Job %s done: %s uploaded, %s failed", job.id, job.ok, job.not_ok)
+    except Exception as e:
+        logger.exception("Job %s failed", job.id)
+        job.status = enums.JobStatus.FAILED
+        job.error = str(e)
+    if not queue.update(job):
+        logger.warning("Job %s was taken over by another process", job.id)
+
+
+def watch(
+    client: client.VgarusClient,
+    queue: JobQueue,
+    directories: list[Path],
+    workers: int = 1,
+    interval: float = 10,
+    settle: float = 10,
+    once: bool = False,
+    **job_options,
+) -> None:
+    """Watches directories for new inputs and uploads them.
+
+    Files modified less than `settle` seconds ago are left for the next scan,
+    changed files of finished jobs are uploaded again.
+    At most `workers` jobs are uploaded at once through the shared client.
+    With `once` exits when the directories are scanned and the queue is drained.
+    Jobs of other processes are requeued only if their heartbeat is stale.
+    `job_options` are passed to `run_job`.
+    """
+
+    # Heartbeats are sent once per interval, leave room for slow iterations
+    stale_after = max(STALE_AFTER, 3 * interval)
+
+    running: dict[Future, models.UploadJob] = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            queue.heartbeat()
+            requeued = queue.requeue_stale(stale_after)
+            if requeued:
+                logger.info("Requeued %s interrupted jobs", requeued)
+
+            for directory in directories:
+                for job in scan(directory, settle=settle):
+                    if queue.enqueue(job):
+                        logger.info("Enqueued %s", job.source)
+
+            while len(running) < workers and (job := queue.take()) is not None:
+                logger.info("Starting job %s: %s", job.id, job.source)
+                future = executor.submit(run_job, client, job, **job_options)
+                running[future] = job
+
+            if once and not running:
+                break
+
+            if running:
+                done, _ = wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _finish(queue, running.pop(future), future)
+            else:
+                time.sleep(interval)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future, job in running.items():
+            if future.cancelled():
+                job.status = enums.JobStatus.PENDING
+                queue.update(job)
+            else:
+                _finish(queue, job, future)
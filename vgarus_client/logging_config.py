@@ -16,7 +16,7 @@ LOGGING = {
             "level": "INFO",
             "class": "logging.StreamHandler",
             "formatter": "basic",
-            "stream": "ext://sys.stdout",
+            "stream": "ext://sys.stderr",
         },
         "file": {
             "level": "DEBUG",
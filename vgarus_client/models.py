@@ -3,6 +3,7 @@ from __future__ import annotations
 import json
 import re
 from datetime import date
+from pathlib import Path
 
 from pydantic import (
     BaseModel,
@@ -164,3 +165,26 @@ class UploadResult(BaseModel):
     @property
     def ok(self) -> bool:
         return self.vgarus_id is not None
+
+
+class UploadJob(BaseModel):
+    id: int | None = None
+    package: Path | None = None
+    metadata: Path | None = None
+    fasta: Path | None = None
+    status: enums.JobStatus = enums.JobStatus.PENDING
+    ok: int = 0
+    not_ok: int = 0
+    error: str | None = None
+    run: str | None = None
+    attempts: int = 0
+    revision: int = 0
+
+    @property
+    def source(self) -> Path:
+        """Input file identifying the job"""
+
+        source = self.package or self.metadata
+        if source is None:
+            raise ValueError("Job has neither package nor metadata")
+        return source
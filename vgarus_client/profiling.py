@@ -0,0 +1,135 @@
+import contextlib
+import cProfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import ContextManager, Generator, Iterable, TypeVar
+
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+STAGES = ("reader", "validator", "cache", "serializer", "http", "writer")
+
+
+class StageStats(BaseModel):
+    calls: int = 0
+    wall: float = 0
+    cpu: float = 0
+    allocated: int = 0
+
+
+class Profiler:
+    """Accumulates wall time, CPU time and optionally allocations per stage.
+
+    CPU time is measured per thread. Allocations are the net change
+    of memory traced by tracemalloc, so with concurrent threads
+    they include allocations made by other threads. Tracing slows down
+    allocation heavy code and skews timings, so it is off by default.
+    """
+
+    def __init__(self, trace_allocations: bool = False) -> None:
+        self.trace_allocations = trace_allocations
+        self.stages: dict[str, StageStats] = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _traced_memory(self) -> int:
+        return tracemalloc.get_traced_memory()[0] if self.trace_allocations else 0
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        memory = self._traced_memory()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            memory = self._traced_memory() - memory
+            with self._lock:
+                stats = self.stages.setdefault(name, StageStats())
+                stats.calls += 1
+                stats.wall += wall
+                stats.cpu += cpu
+                stats.allocated += memory
+
+    def format_table(self) -> str:
+        total = time.perf_counter() - self.started
+        names = sorted(
+            self.stages,
+            key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES),
+        )
+        alloc_header = f"{'alloc, MB':>12}" if self.trace_allocations else ""
+        lines = [
+            f"{'stage':<12}{'calls':>10}{'wall, s':>12}{'cpu, s':>12}"
+            f"{alloc_header}{'wall, %':>10}"
+        ]
+        for name in names:
+            stats = self.stages[name]
+            allocated = (
+                f"{stats.allocated / 2**20:>12.2f}" if self.trace_allocations else ""
+            )
+            lines.append(
+                f"{name:<12}{stats.calls:>10}{stats.wall:>12.3f}{stats.cpu:>12.3f}"
+                f"{allocated}{100 * stats.wall / total:>10.1f}"
+            )
+        lines.append(f"{'total':<12}{'':>10}{total:>12.3f}")
+        return "\n".join(lines)
+
+
+_profiler: Profiler | None = None
+_null_stage = contextlib.nullcontext()
+
+
+def stage(name: str) -> ContextManager:
+    """Measures a stage if profiling is enabled, does nothing otherwise"""
+
+    if _profiler is None:
+        return _null_stage
+    return _profiler.stage(name)
+
+
+def iter_stage(iterable: Iterable[T], name: str) -> Generator[T, None, None]:
+    """Measures fetching items from iterable, but not their processing"""
+
+    if _profiler is None:
+        yield from iterable
+        return
+
+    it = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextlib.contextmanager
+def profile(
+    pstats_output: Path | None = None, trace_allocations: bool = False
+) -> Generator[Profiler, None, None]:
+    """Enables stage profiling, optionally dumps cProfile stats of the main thread"""
+
+    global _profiler
+
+    if trace_allocations:
+        tracemalloc.start()
+    profiler = Profiler(trace_allocations=trace_allocations)
+    c_profile = cProfile.Profile() if pstats_output is not None else None
+    _profiler = profiler
+    if c_profile is not None:
+        c_profile.enable()
+    try:
+        yield profiler
+    finally:
+        if c_profile is not None:
+            c_profile.disable()
+            c_profile.dump_stats(pstats_output)
+        _profiler = None
+        if trace_allocations:
+            tracemalloc.stop()
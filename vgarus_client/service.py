@@ -1,15 +1,21 @@
+import json
 import logging
-import math
+import time
 from pathlib import Path
-from typing import Generator
+from typing import Callable, Generator, Iterable
 
-from vgarus_client import client, models, utils
+import requests
+
+from vgarus_client import client, models, profiling, sinks, utils
 
 logger = logging.getLogger("vgarus")
 
 
 def get_client(
-    username: str | None, password: str | None, env: Path | None
+    username: str | None,
+    password: str | None,
+    env: Path | None,
+    session: requests.Session | None = None,
 ) -> client.VgarusClient | None:
     try:
         if username and password:
@@ -22,12 +28,14 @@ def get_client(
         logger.exception("No credentials")
         return None
 
-    return client.VgarusClient(auth=vgarus_auth)
+    return client.VgarusClient(auth=vgarus_auth, session=session)
 
 
 def get_upload_results(
-    batch: list[models.Sample], response: models.VgarusResponse
+    batch: list[models.Sample], response: models.VgarusResponse | None
 ) -> list[models.UploadResult]:
+    """Matches vgarus ids to samples, none are matched without a response"""
+
     results = [
         models.UploadResult(
             virus_name=sample.sample_data.virus_name,
@@ -36,7 +44,7 @@ def get_upload_results(
         for sample in batch
     ]
 
-    if response.status != 200:
+    if response is None or response.status != 200:
         return results
 
     virus_names_in_errors = response.get_errors_virus_names()
@@ -51,28 +59,124 @@ def get_upload_results(
     return results
 
 
+def get_payload_size(sample: models.Sample) -> int:
+    """Size of the sample in the upload request body.
+
+    The body is a json array, so each sample also takes a two byte
+    separator, or the brackets for the last one, and sizes of a batch
+    sum up to the body size.
+    """
+
+    return len(json.dumps(sample.export())) + 2
+
+
+def iter_batches(
+    samples: Iterable[models.Sample],
+    batch_size: int | None = None,
+    max_batch_bytes: int | None = None,
+    packing_window: int = 1,
+) -> Generator[list[models.Sample], None, None]:
+    """Splits samples to batches of batch_size (one by default) or,
+    if max_batch_bytes is set, by payload size with at most batch_size
+    samples per batch if it is set"""
+
+    if max_batch_bytes is None:
+        yield from utils.iter_batches(samples, batch_size or 1)
+    else:
+        yield from utils.iter_batches_by_weight(
+            samples,
+            weight=get_payload_size,
+            max_weight=max_batch_bytes,
+            max_size=batch_size,
+            window=packing_window,
+        )
+
+
+def make_batches(
+    samples: Iterable[models.Sample],
+    batch_size: int | None = None,
+    max_batch_bytes: int | None = None,
+    packing_window: int = 1,
+) -> Iterable[list[models.Sample]]:
+    """Batches a list of samples at once so the number of batches is known,
+    streamed samples are batched on the fly"""
+
+    batches = iter_batches(samples, batch_size, max_batch_bytes, packing_window)
+    if isinstance(samples, list):
+        return list(batches)
+    return batches
+
+
 def upload_samples(
     client: client.VgarusClient,
-    samples: list[models.Sample],
-    batch_size: int = 1,
+    batches: Iterable[list[models.Sample]],
+    deadline: float | None = None,
 ) -> Generator[tuple[list[models.UploadResult], list[models.Sample]], None, None,]:
-    """Handles batched upload and gathering results"""
+    """Handles batched upload and gathering results.
 
-    batch_number = math.ceil(len(samples) / batch_size)
-    logger.info(
-        "Uploading %s records in %s batches by %s",
-        len(samples),
-        batch_number,
-        batch_size,
-    )
+    Batches that failed or weren't sent within deadline seconds
+    get results without vgarus ids.
+    """
 
-    for batch in utils.iter_batches(samples, batch_size):
-        vgarus_response = client.send_batch(batch)
-        logger.debug("%s", vgarus_response.json())
+    if isinstance(batches, list):
+        logger.info(
+            "Uploading %s records in %s batches",
+            sum(len(batch) for batch in batches),
+            len(batches),
+        )
+    else:
+        logger.info("Uploading records from stream")
 
-        if vgarus_response.status == 200:
-            result = get_upload_results(batch, vgarus_response)
+    expires = time.monotonic() + deadline if deadline is not None else None
+    skipped = 0
 
-            yield result, batch
-        else:
-            yield [], []
+    for batch in batches:
+        remaining = expires - time.monotonic() if expires is not None else None
+        if remaining is not None and remaining <= 0:
+            skipped += len(batch)
+            yield get_upload_results(batch, None), batch
+            continue
+
+        vgarus_response: models.VgarusResponse | None
+        try:
+            vgarus_response = client.send_batch(batch, max_timeout=remaining)
+            logger.debug("%s", vgarus_response.json())
+        except ValueError as e:
+            logger.warning("Batch of %s records failed: %s", len(batch), e)
+            vgarus_response = None
+
+        yield get_upload_results(batch, vgarus_response), batch
+
+    if skipped:
+        logger.warning("Deadline exceeded, %s records weren't sent", skipped)
+
+
+def upload_samples_to_sink(
+    client: client.VgarusClient,
+    batches: Iterable[list[models.Sample]],
+    sink: sinks.ResultSink,
+    on_batch: Callable[[int, int], None] | None = None,
+    deadline: float | None = None,
+) -> tuple[int, int]:
+    """Uploads samples writing results and leftover samples to an opened sink.
+
+    Returns numbers of uploaded and failed samples.
+    """
+
+    ok, not_ok = 0, 0
+    for result, batch in upload_samples(client, batches=batches, deadline=deadline):
+        uploaded, leftover = [], []
+        for upload_result, sample in zip(result, batch):
+            if upload_result.ok:
+                uploaded.append(upload_result)
+            else:
+                leftover.append(sample)
+        with profiling.stage("writer"):
+            sink.write_batch(uploaded, leftover)
+
+        ok += len(uploaded)
+        not_ok += len(leftover)
+        if on_batch is not None:
+            on_batch(ok, not_ok)
+
+    return ok, not_ok
@@ -0,0 +1,460 @@
+import abc
+import csv
+import json
+import logging
+import sqlite3
+import sys
+import uuid
+from datetime import date, datetime
+from pathlib import Path
+from typing import IO, Iterable
+
+from . import io_utils, models
+
+logger = logging.getLogger("vgarus")
+
+SINK_KINDS = ("tsv", "jsonl", "sqlite")
+LEFTOVER_PACKAGE_FORMATS = ("fasta", "json")
+
+RESULT_FIELDS = list(models.UploadResult.__fields__.keys())
+LEFTOVER_FIELDS = list(models.SampleData.__fields__.keys())
+# SQLite rows also record the run and its input
+RUN_FIELDS = ["run", "source", "created"]
+INDEXED_RESULT_FIELDS = ("run", "source", "virus_name", "gisaid_id", "vgarus_id")
+INDEXED_LEFTOVER_FIELDS = ("run", "source", "virus_name", "gisaid_id")
+
+
+class ResultSink(abc.ABC):
+    """Destination for upload results and failed samples.
+
+    Each batch is written as a whole, so an interrupted run leaves
+    complete batches only.
+    """
+
+    def existing_outputs(self) -> list[Path]:
+        """Outputs that would be overwritten"""
+
+        return []
+
+    def resume(self) -> tuple[set[str], set[str]]:
+        """Continues outputs of an interrupted run instead of overwriting them.
+
+        Called before `open`, returns virus names of uploaded and failed
+        samples written by the interrupted run.
+        """
+
+        return set(), set()
+
+    def open(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def write_batch(
+        self, results: list[models.UploadResult], leftover: list[models.Sample]
+    ) -> None:
+        ...
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _truncate_partial_line(path: Path) -> None:
+    """Drops the last line if its writing was interrupted"""
+
+    with open(path, "rb+") as fo:
+        data = fo.read()
+        if data and not data.endswith(b"\n"):
+            fo.truncate(data.rfind(b"\n") + 1)
+
+
+class _FileSink(ResultSink):
+    results_suffix: str
+    leftover_suffix: str
+
+    def __init__(self, base: Path) -> None:
+        self.results_path = base.with_suffix(self.results_suffix)
+        self.leftover_path = base.with_suffix(self.leftover_suffix)
+        self.leftover_count = 0
+        self.append = False
+        self._results_o: IO[str] | None = None
+        self._leftover_o: IO[str] | None = None
+
+    def existing_outputs(self) -> list[Path]:
+        if self.append:
+            return []
+        return [
+            path for path in (self.results_path, self.leftover_path) if path.exists()
+        ]
+
+    def resume(self) -> tuple[set[str], set[str]]:
+        self.append = True
+        uploaded = self._read_virus_names(self.results_path)
+        failed = self._read_virus_names(self.leftover_path)
+        self.leftover_count = len(failed)
+        return set(uploaded), set(failed)
+
+    def _read_virus_names(self, path: Path) -> list[str]:
+        if not path.exists():
+            return []
+        _truncate_partial_line(path)
+        with open(path, newline="") as fi:
+            return self._parse_virus_names(fi)
+
+    @abc.abstractmethod
+    def _parse_virus_names(self, fi: IO[str]) -> list[str]:
+        ...
+
+    def open(self) -> None:
+        mode = "a" if self.append else "w"
+        # Line breaks inside csv fields are kept as is
+        self._results_o = open(self.results_path, mode, newline="")
+        self._leftover_o = open(self.leftover_path, mode, newline="")
+
+    @abc.abstractmethod
+    def _write_results(self, results: list[models.UploadResult]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def _write_leftover(self, leftover: list[models.Sample]) -> None:
+        ...
+
+    def write_batch(
+        self, results: list[models.UploadResult], leftover: list[models.Sample]
+    ) -> None:
+        assert self._results_o is not None and self._leftover_o is not None
+        self._write_results(results)
+        self._write_leftover(leftover)
+        self._results_o.flush()
+        self._leftover_o.flush()
+        self.leftover_count += len(leftover)
+
+    def close(self) -> None:
+        for fo in (self._results_o, self._leftover_o):
+            if fo is not None:
+                fo.close()
+        if self._leftover_o is not None and self.leftover_count == 0:
+            self.leftover_path.unlink()
+
+
+class TsvSink(_FileSink):
+    results_suffix = ".result.tsv"
+    leftover_suffix = ".leftover.tsv"
+
+    def open(self) -> None:
+        super().open()
+        self._results_writer = csv.DictWriter(
+            self._results_o, fieldnames=RESULT_FIELDS, delimiter="\t"  # type: ignore
+        )
+        self._leftover_writer = csv.DictWriter(
+            self._leftover_o, fieldnames=LEFTOVER_FIELDS, delimiter="\t"  # type: ignore
+        )
+        # Appended files already have the header
+        if self._results_o.tell() == 0:  # type: ignore
+            self._results_writer.writeheader()
+        if self._leftover_o.tell() == 0:  # type: ignore
+            self._leftover_writer.writeheader()
+
+    def _parse_virus_names(self, fi: IO[str]) -> list[str]:
+        return [row["virus_name"] for row in csv.DictReader(fi, delimiter="\t")]
+
+    def _write_results(self, results: list[models.UploadResult]) -> None:
+        self._results_writer.writerows(result.dict() for result in results)
+
+    def _write_leftover(self, leftover: list[models.Sample]) -> None:
+        self._leftover_writer.writerows(
+            sample.sample_data.dict() for sample in leftover
+        )
+
+
+class JsonLinesSink(_FileSink):
+    results_suffix = ".result.jsonl"
+    leftover_suffix = ".leftover.jsonl"
+
+    def _parse_virus_names(self, fi: IO[str]) -> list[str]:
+        return [json.loads(line)["virus_name"] for line in fi if line.strip()]
+
+    def _write_results(self, results: list[models.UploadResult]) -> None:
+        assert self._results_o is not None
+        self._results_o.writelines(f"{result.json()}\n" for result in results)
+
+    def _write_leftover(self, leftover: list[models.Sample]) -> None:
+        assert self._leftover_o is not None
+        self._leftover_o.writelines(
+            f"{sample.sample_data.json(ensure_ascii=False)}\n" for sample in leftover
+        )
+
+
+def _to_row(data: dict, fields: Iterable[str]) -> tuple:
+    return tuple(
+        data[field].isoformat() if isinstance(data[field], date) else data[field]
+        for field in fields
+    )
+
+
+class SqliteSink(ResultSink):
+    """Appends results and leftover to `results` and `leftover` tables.
+
+    The database may be shared between runs to keep submission history,
+    rows are marked with the run id, the input file and the write time.
+    """
+
+    def __init__(
+        self, path: Path, source: Path | None = None, run: str | None = None
+    ) -> None:
+        self.path = path
+        self.run = run or uuid.uuid4().hex
+        self.source = str(source.resolve()) if source is not None else None
+        self.connection: sqlite3.Connection | None = None
+
+    def resume(self) -> tuple[set[str], set[str]]:
+        if not self.path.exists():
+            return set(), set()
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            uploaded, failed = (
+                {
+                    row[0]
+                    for row in connection.execute(
+                        f"SELECT virus_name FROM {table} WHERE run = ?", (self.run,)
+                    )
+                }
+                for table in ("results", "leftover")
+            )
+        except sqlite3.OperationalError:
+            # Tables are created on the first write
+            return set(), set()
+        finally:
+            connection.close()
+        return uploaded, failed
+
+    def open(self) -> None:
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            for table, fields, indexed in (
+                ("results", RESULT_FIELDS, INDEXED_RESULT_FIELDS),
+                ("leftover", LEFTOVER_FIELDS, INDEXED_LEFTOVER_FIELDS),
+            ):
+                self.connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} "
+                    f"({', '.join(RUN_FIELDS + fields)})"
+                )
+                for field in indexed:
+                    self.connection.execute(
+                        f"CREATE INDEX IF NOT EXISTS {table}_{field} "
+                        f"ON {table} ({field})"
+                    )
+
+    def _insert(self, table: str, fields: list[str], rows: Iterable[dict]) -> None:
+        assert self.connection is not None
+        run = {
+            "run": self.run,
+            "source": self.source,
+            "created": datetime.now().isoformat(),
+        }
+        all_fields = RUN_FIELDS + fields
+        self.connection.executemany(
+            f"INSERT INTO {table} ({', '.join(all_fields)}) "
+            f"VALUES ({', '.join('?' * len(all_fields))})",
+            (_to_row(run | row, all_fields) for row in rows),
+        )
+
+    def write_batch(
+        self, results: list[models.UploadResult], leftover: list[models.Sample]
+    ) -> None:
+        assert self.connection is not None
+        with self.connection:
+            self._insert(
+                "results", RESULT_FIELDS, (result.dict() for result in results)
+            )
+            self._insert(
+                "leftover",
+                LEFTOVER_FIELDS,
+                (sample.sample_data.dict() for sample in leftover),
+            )
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+
+
+class StdoutSink(ResultSink):
+    """Streams results of all samples to stdout as JSON Lines.
+
+    Failed samples get results without `vgarus_id`.
+    """
+
+    def write_batch(
+        self, results: list[models.UploadResult], leftover: list[models.Sample]
+    ) -> None:
+        failed = [
+            models.UploadResult(
+                virus_name=sample.sample_data.virus_name,
+                gisaid_id=sample.sample_data.gisaid_id,
+            )
+            for sample in leftover
+        ]
+        sys.stdout.writelines(f"{result.json()}\n" for result in results + failed)
+        sys.stdout.flush()
+
+
+def _count_json_items(text: str) -> tuple[int, int]:
+    """Counts complete items of an unclosed json array.
+
+    Returns the count and the offset after the last complete item.
+    """
+
+    decoder = json.JSONDecoder()
+    count = 0
+    end = pos = text.find("[") + 1
+    while True:
+        while pos < len(text) and text[pos] in ", \n":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            break
+        try:
+            _, pos = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            break
+        count += 1
+        end = pos
+    return count, end
+
+
+class LeftoverPackageSink(ResultSink):
+    """Writes sequences of failed samples for a later retry.
+
+    `fasta` format is paired with leftover metadata from another sink,
+    `json` format is a complete package for upload.
+    """
+
+    def __init__(self, base: Path, format: str = "fasta") -> None:
+        if format not in LEFTOVER_PACKAGE_FORMATS:
+            raise ValueError(f"Unknown leftover package format: {format}")
+        self.format = format
+        self.path = base.with_suffix(f".leftover.{format}")
+        self.count = 0
+        self.append = False
+        self._fo: IO[str] | None = None
+
+    def existing_outputs(self) -> list[Path]:
+        if self.append:
+            return []
+        return [self.path] if self.path.exists() else []
+
+    def resume(self) -> tuple[set[str], set[str]]:
+        self.append = True
+        if self.path.exists() and self.format == "fasta":
+            _truncate_partial_line(self.path)
+            self.count = self.path.read_text().count(">")
+        elif self.path.exists():
+            # The array is closed on `close`, continue after the last sample
+            text = self.path.read_text()
+            self.count, end = _count_json_items(text)
+            with open(self.path, "rb+") as fo:
+                fo.truncate(len(text[:end].encode()))
+        return set(), set()
+
+    def open(self) -> None:
+        self._fo = open(self.path, "a" if self.append else "w")
+        if self.format == "json" and self._fo.tell() == 0:
+            self._fo.write("[")
+
+    def write_batch(
+        self, results: list[models.UploadResult], leftover: list[models.Sample]
+    ) -> None:
+        assert self._fo is not None
+        for sample in leftover:
+            if self.format == "fasta":
+                self._fo.write(f"{sample.sequence.to_fasta()}\n")
+            else:
+                separator = ", " if self.count else ""
+                self._fo.write(
+                    separator + json.dumps(sample.export(), ensure_ascii=False)
+                )
+            self.count += 1
+        self._fo.flush()
+
+    def close(self) -> None:
+        if self._fo is None:
+            return
+        if self.format == "json":
+            self._fo.write("]")
+        self._fo.close()
+        if self.count == 0:
+            self.path.unlink()
+
+
+class CombinedSink(ResultSink):
+    """Writes the same batches to several sinks"""
+
+    def __init__(self, *sinks: ResultSink) -> None:
+        self.sinks = sinks
+
+    def existing_outputs(self) -> list[Path]:
+        return [path for sink in self.sinks for path in sink.existing_outputs()]
+
+    def resume(self) -> tuple[set[str], set[str]]:
+        uploaded: set[str] = set()
+        failed: set[str] = set()
+        for sink in self.sinks:
+            sink_uploaded, sink_failed = sink.resume()
+            uploaded |= sink_uploaded
+            failed |= sink_failed
+        return uploaded, failed
+
+    def open(self) -> None:
+        for sink in self.sinks:
+            sink.open()
+
+    def write_batch(
+        self, results: list[models.UploadResult], leftover: list[models.Sample]
+    ) -> None:
+        for sink in self.sinks:
+            sink.write_batch(results, leftover)
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+
+def get_sink(
+    kind: str,
+    base: Path,
+    database: Path | None = None,
+    leftover_package: str | None = None,
+    source: Path | None = None,
+    run: str | None = None,
+) -> ResultSink:
+    """Creates a sink writing outputs next to `base`, or to stdout for `-`.
+
+    `source` and `run` are the input file and the run id recorded
+    in the sqlite sink.
+    """
+
+    sink: ResultSink
+    if io_utils.is_stdio(base):
+        if leftover_package is not None:
+            raise ValueError("Leftover package can't be written to stdout")
+        return StdoutSink()
+    if kind == "tsv":
+        sink = TsvSink(base)
+    elif kind == "jsonl":
+        sink = JsonLinesSink(base)
+    elif kind == "sqlite":
+        sink = SqliteSink(
+            database or base.with_suffix(".result.sqlite"), source=source, run=run
+        )
+    else:
+        raise ValueError(f"Unknown sink: {kind}")
+
+    if leftover_package is None:
+        return sink
+    return CombinedSink(sink, LeftoverPackageSink(base, format=leftover_package))
@@ -1,6 +1,6 @@
 import itertools
 import re
-from typing import Generator, Iterable, TypeVar
+from typing import Callable, Generator, Iterable, TypeVar
 
 T = TypeVar("T")
 
@@ -32,3 +32,51 @@ def iter_batches(data: Iterable[T], size: int) -> Generator[list[T], None, None]
     it = iter(data)
     while batch := list(itertools.islice(it, size)):
         yield batch
+
+
+def iter_batches_by_weight(
+    data: Iterable[T],
+    weight: Callable[[T], int],
+    max_weight: int,
+    max_size: int | None = None,
+    window: int = 1,
+) -> Generator[list[T], None, None]:
+    """Batch data into lists of at most max_size items, if set, with total weight
+    up to max_weight. An item heavier than max_weight makes a batch of its own.
+
+    With a window larger than one, the next `window` items are searched
+    for one that fits the current batch, so items may be reordered
+    within the window to fill batches evenly.
+    """
+
+    if max_size is not None and max_size < 1:
+        raise ValueError("max_size must be at least one")
+    it = iter(data)
+    pending: list[tuple[T, int]] = []
+    batch: list[T] = []
+    batch_weight = 0
+    while True:
+        pending.extend(
+            (item, weight(item))
+            for item in itertools.islice(it, max(window, 1) - len(pending))
+        )
+        if not pending:
+            break
+
+        for i, (item, item_weight) in enumerate(pending):
+            if not batch or batch_weight + item_weight <= max_weight:
+                del pending[i]
+                batch.append(item)
+                batch_weight += item_weight
+                break
+        else:
+            yield batch
+            batch, batch_weight = [], 0
+            continue
+
+        if len(batch) == max_size:
+            yield batch
+            batch, batch_weight = [], 0
+
+    if batch:
+        yield batch